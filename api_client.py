@@ -3,80 +3,1358 @@ API Client for multiple AI providers
 Supports: Gemini, Groq, OpenRouter, Bytez
 """
 
-import requests
+import threading
+import time
+import hashlib
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import json
+import os
+import re
+import socket
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
 from storage import StorageManager
+from image_cache import ImageCache
+from tasks import CancelToken
+import tracing
+
+
+# Every provider host gets its own keep-alive connection pool
+PROVIDER_HOSTS = {
+    'groq': 'https://api.groq.com',
+    'gemini': 'https://generativelanguage.googleapis.com',
+    'openrouter': 'https://openrouter.ai',
+    'bytez': 'https://api.bytez.com',
+}
+
+# Model used for each provider; part of the response cache key
+PROVIDER_MODELS = {
+    'groq': 'llama-3.3-70b-versatile',
+    'gemini': 'gemini-1.5-flash',
+    'openrouter': 'google/gemini-2.0-flash-exp:free',
+    'bytez': 'flux-schnell',
+}
+
+# Smaller, faster models for generation profiles with fast_model set;
+# providers without one keep their PROVIDER_MODELS entry
+FAST_MODELS = {
+    'groq': 'llama-3.1-8b-instant',
+    'gemini': 'gemini-1.5-flash-8b',
+}
+
+# Request parameters when the caller does not override them
+DEFAULT_PARAMS = {
+    'temperature': 0.7,
+    'max_tokens': 500,
+    'json': False,  # Ask the provider for a JSON object response
+    'stop': (),  # Stop sequences
+    'fast_model': False,  # Use the provider's FAST_MODELS entry
+}
+
+# Where a single post is over: models like to tack on alternative versions after it
+POST_STOP_SEQUENCES = ('\n---', '\nOption 2', '\n**Option 2')
+
+# Generation profile per platform, merged over DEFAULT_PARAMS. Every token
+# generated past what the platform takes is latency, so budgets sit a little
+# above the longest post wanted (roughly 4 characters per token, emojis cost more)
+PLATFORM_PROFILES = {
+    'Twitter': {'max_tokens': 120, 'fast_model': True},
+    'Instagram': {'max_tokens': 350},
+    'Facebook': {'max_tokens': 350},
+    'LinkedIn': {'max_tokens': 600},
+    'General': {'max_tokens': 400},
+}
+
+# Sampling per tone, merged over the platform profile
+TONE_PROFILES = {
+    'Professional': {'temperature': 0.6},
+    'Casual': {'temperature': 0.8},
+    'Enthusiastic': {'temperature': 0.8},
+    'Formal': {'temperature': 0.5},
+    'Funny': {'temperature': 0.9},
+    'Inspirational': {'temperature': 0.8},
+}
+
+PLATFORM_INSTRUCTIONS = {
+    'Twitter': 'Create a concise, engaging tweet (max 280 characters). Use emojis strategically.',
+    'LinkedIn': 'Write a professional post suitable for LinkedIn. Focus on value and insights.',
+    'Instagram': 'Create an engaging caption perfect for Instagram. Use relevant hashtags.',
+    'Facebook': 'Write a friendly, shareable Facebook post that encourages engagement.',
+    'General': 'Create engaging social media content.'
+}
+
+TONE_INSTRUCTIONS = {
+    'Professional': 'Use a professional, polished tone.',
+    'Casual': 'Write in a casual, conversational style.',
+    'Enthusiastic': 'Be energetic and enthusiastic!',
+    'Formal': 'Maintain a formal, authoritative tone.',
+    'Funny': 'Make it humorous and entertaining.',
+    'Inspirational': 'Be motivational and uplifting.'
+}
+
+# Platforms covered by a single multi-platform request
+MULTI_PLATFORMS = ('Twitter', 'LinkedIn', 'Instagram', 'Facebook')
+
+# Hard length limits a generated post must respect
+PLATFORM_MAX_CHARS = {
+    'Twitter': 280,
+    'Instagram': 2200,
+    'LinkedIn': 3000,
+}
+
+# Free-tier requests per minute of one key, used to pace batch generation
+PROVIDER_RATE_LIMITS = {
+    'groq': 30,
+    'gemini': 15,
+    'openrouter': 20,
+}
+
+
+def generation_params(platform, tone):
+    """Request parameters for one post: DEFAULT_PARAMS, then the platform's and the tone's profile"""
+    return {
+        **DEFAULT_PARAMS,
+        'stop': POST_STOP_SEQUENCES,
+        **PLATFORM_PROFILES.get(platform, PLATFORM_PROFILES['General']),
+        **TONE_PROFILES.get(tone, {}),
+    }
+
+
+def model_for(provider, params=None):
+    """Model a request with these parameters goes to"""
+    if params and params.get('fast_model'):
+        return FAST_MODELS.get(provider, PROVIDER_MODELS[provider])
+    return PROVIDER_MODELS[provider]
+
+
+def trim_post(text, max_chars, min_keep=0.5):
+    """
+    text cut down to max_chars where it costs the least, or None when that
+    would leave less than min_keep of the limit
+    Trailing hashtags go first, then whole sentences from the end.
+    """
+    if len(text) <= max_chars:
+        return text
+    while len(text) > max_chars:
+        hashtag = re.search(r'\s+#\w+\s*$', text)
+        if hashtag is None:
+            break
+        text = text[:hashtag.start()]
+    if len(text) <= max_chars:
+        return text
+    ends = [match.end() for match in re.finditer(r'[.!?…](?=\s|$)', text[:max_chars])]
+    if ends and ends[-1] >= max_chars * min_keep:
+        return text[:ends[-1]]
+    return None
+
+
+class RequestCancelled(Exception):
+    """Raised when a provider request is abandoned (e.g. it lost a hedged race)"""
+
+
+class ProvidersUnreachable(Exception):
+    """Raised when every provider with a key failed to connect, i.e. the device looks offline"""
+
+
+def is_connection_error(error):
+    """
+    True for failures to reach a host at all, as opposed to errors the host answered with
+    A read timeout means the connection was made, so the network is up.
+    """
+    import requests  # Already loaded by SessionPool once a request has been made
+    return isinstance(error, (requests.ConnectionError, requests.ConnectTimeout))
+
+
+def providers_failed(errors, message=None):
+    """The exception for a request no provider could answer"""
+    if errors and all(is_connection_error(error) for error in errors):
+        return ProvidersUnreachable("Could not connect to any provider. Check your internet connection.")
+    return Exception(message or "No API keys configured or all providers failed. Please add API keys in Settings.")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _LeaderGone(Exception):
+    """The call being waited on was cancelled by its own caller"""
+
+
+class SingleFlight:
+    """Lets concurrent calls with the same key share one execution and its result"""
+    
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+    
+    def do(self, key, fn, cancel=None):
+        """Run fn() unless an identical call is in flight, in which case wait for its result"""
+        while True:
+            flight, leader = self.join(key)
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    self.finish(key, flight, error=e)
+                    raise
+                self.finish(key, flight, result=result)
+                return result
+            try:
+                return self.wait(flight, cancel)
+            except _LeaderGone:
+                continue  # Try again, possibly as the leader this time
+    
+    def join(self, key):
+        """Returns (flight, is_leader); the leader must call finish()"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                self.executed += 1
+                return flight, True
+            self.coalesced += 1
+            return flight, False
+    
+    def wait(self, flight, cancel=None):
+        """Result of another caller's flight; _LeaderGone if that caller gave up"""
+        while not flight.done.wait(0.2 if cancel is not None else None):
+            if cancel.is_set():
+                raise RequestCancelled('coalesced request')
+        if isinstance(flight.error, (RequestCancelled, GeneratorExit)):
+            raise _LeaderGone()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    
+    def finish(self, key, flight, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.result = result
+        flight.error = error
+        flight.done.set()
+    
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced}
+
+
+class SessionPool:
+    """Pooled keep-alive HTTP sessions, one per provider host"""
+    
+    def __init__(self, pool_size=4, idle_timeout=60):
+        # Imported with the first pool rather than with this module, to keep the
+        # HTTP stack out of app startup and out of the first request's latency
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._new_session = requests.Session
+        self._new_adapter = HTTPAdapter
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._last_used = {}
+        self._in_flight = {}
+        self._retired = {}  # Counters of sessions recycled after going idle
+        self._lock = threading.Lock()
+    
+    def session(self, provider):
+        """Get the session for a provider, recycling it if it sat idle too long"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(provider)
+            if (session is not None and not self._in_flight.get(provider)
+                    and now - self._last_used[provider] > self.idle_timeout):
+                # Servers drop idle sockets anyway, start over with a clean pool
+                self._retire(provider)
+                session = None
+            if session is None:
+                session = self._new_session()
+                adapter = self._new_adapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[provider] = session
+            self._last_used[provider] = now
+            return session
+    
+    def post(self, provider, url, cancel=None, **kwargs):
+        """POST through the provider's pooled session"""
+        return self.request('POST', provider, url, cancel, **kwargs)
+    
+    def get(self, provider, url, cancel=None, **kwargs):
+        """GET through the provider's pooled session"""
+        return self.request('GET', provider, url, cancel, **kwargs)
+    
+    def request(self, method, provider, url, cancel=None, **kwargs):
+        if cancel is not None and cancel.is_set():
+            raise RequestCancelled(provider)
+        session = self.session(provider)
+        with self._lock:
+            self._in_flight[provider] = self._in_flight.get(provider, 0) + 1
+        try:
+            with tracing.span('http.request', provider=provider, method=method) as span:
+                opened = self._count(session)[1] if tracing.is_enabled() else 0
+                response = session.request(method, url, **kwargs)
+                if tracing.is_enabled():
+                    # Tells connection setup apart from server time in the trace
+                    span.set(status=response.status_code, new_connection=self._count(session)[1] > opened)
+            if cancel is not None and cancel.is_set():
+                # Nobody is waiting for this answer any more
+                response.close()
+                raise RequestCancelled(provider)
+            return response
+        finally:
+            with self._lock:
+                self._in_flight[provider] -= 1
+                self._last_used[provider] = time.monotonic()
+    
+    def stats(self):
+        """Requests, new connections and reused connections per provider"""
+        with self._lock:
+            stats = {}
+            for provider in set(self._sessions) | set(self._retired):
+                sent, opened = self._retired.get(provider, (0, 0))
+                if provider in self._sessions:
+                    live_sent, live_opened = self._count(self._sessions[provider])
+                    sent += live_sent
+                    opened += live_opened
+                stats[provider] = {
+                    'requests': sent,
+                    'connections': opened,
+                    'reused': max(sent - opened, 0),
+                }
+            return stats
+    
+    def close(self):
+        """Close every pooled connection"""
+        with self._lock:
+            for provider in list(self._sessions):
+                self._retire(provider)
+    
+    def _retire(self, provider):
+        session = self._sessions.pop(provider)
+        sent, opened = self._count(session)
+        old_sent, old_opened = self._retired.get(provider, (0, 0))
+        self._retired[provider] = (old_sent + sent, old_opened + opened)
+        session.close()
+    
+    @staticmethod
+    def _count(session):
+        """Sum urllib3 pool counters over every adapter of a session"""
+        sent, opened = 0, 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                sent += pool.num_requests
+                opened += pool.num_connections
+        return sent, opened
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at a requests-per-minute rate"""
+    
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60.0
+        # Default burst is ten seconds' worth of requests
+        self.capacity = burst or max(1, rate_per_minute // 6)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def try_acquire(self):
+        """Take a token; returns 0 on success or the seconds until one is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+    
+    def set_rate(self, rate_per_minute, burst=None):
+        """Change the refill rate, e.g. when keys are added to the provider's pool"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate_per_minute / 60.0
+            self.capacity = burst or max(1, rate_per_minute // 6)
+            self._tokens = min(self._tokens, self.capacity)
+
+
+class KeyPool:
+    """
+    Round-robin over each provider's API keys
+    A key answered with 429 sits out the response's Retry-After (default_cooldown
+    seconds without one) while the provider's other keys carry on. Every
+    request is counted against its key in storage.
+    """
+    
+    def __init__(self, storage=None, default_cooldown=60):
+        self.storage = storage
+        self.default_cooldown = default_cooldown
+        self._pools = {}
+        self._next = {}
+        self._benched = {}  # (provider, key) -> monotonic time it may be used again
+        self._lock = threading.Lock()
+    
+    def update(self, pools):
+        """Replace the keys ({provider: [keys]}); benched keys that remain stay benched"""
+        with self._lock:
+            self._pools = {provider: list(keys) for provider, keys in pools.items() if keys}
+            self._benched = {
+                (provider, key): until for (provider, key), until in self._benched.items()
+                if key in self._pools.get(provider, ())
+            }
+    
+    def size(self, provider):
+        with self._lock:
+            return len(self._pools.get(provider, ()))
+    
+    def available(self, provider):
+        """True if the provider has a key that is not sitting out a 429"""
+        return self.wait_time(provider) == 0
+    
+    def wait_time(self, provider):
+        """Seconds until one of the provider's keys may be used (inf without keys)"""
+        with self._lock:
+            keys = self._pools.get(provider)
+            if not keys:
+                return float('inf')
+            now = time.monotonic()
+            return max(0.0, min(self._benched.get((provider, key), 0) - now for key in keys))
+    
+    def acquire(self, provider):
+        """The provider's next usable key, in turn"""
+        with self._lock:
+            keys = self._pools.get(provider)
+            if not keys:
+                raise Exception(f"{provider} API key not configured")
+            now = time.monotonic()
+            start = self._next.get(provider, 0)
+            for offset in range(len(keys)):
+                index = (start + offset) % len(keys)
+                if self._benched.get((provider, keys[index]), 0) <= now:
+                    self._next[provider] = index + 1
+                    return keys[index]
+            wait_time = min(self._benched[(provider, key)] for key in keys) - now
+        raise Exception(f"Every {provider} API key is rate limited, next one free in {wait_time:.0f}s")
+    
+    def record(self, provider, api_key, response):
+        """Count a request against api_key; returns True (and benches the key) on a 429"""
+        rate_limited = response.status_code == 429
+        if rate_limited:
+            cooldown = self.retry_after(response)
+            with self._lock:
+                self._benched[(provider, api_key)] = time.monotonic() + cooldown
+            print(f"{provider} key ...{api_key[-4:]} rate limited, benched for {cooldown:.0f}s")
+        if self.storage is not None:
+            try:
+                self.storage.record_key_usage(provider, api_key, rate_limited)
+            except Exception as e:
+                print(f"could not record key usage: {e}")
+        return rate_limited
+    
+    def benched_for(self, provider, api_key):
+        """Seconds api_key still sits out, 0 if usable"""
+        with self._lock:
+            return max(0.0, self._benched.get((provider, api_key), 0) - time.monotonic())
+    
+    def retry_after(self, response):
+        """Seconds a Retry-After header (delay or HTTP date) asks for"""
+        value = response.headers.get('Retry-After')
+        if value:
+            try:
+                return max(1.0, float(value))
+            except ValueError:
+                pass
+            try:
+                return max(1.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+        return self.default_cooldown
+
+
+class ProviderHealth:
+    """
+    Rolling latency (of successful calls) and error stats plus a circuit breaker per provider
+    A circuit opens after failure_threshold consecutive failures. Once its
+    cooldown has passed, a single request is let through as a probe (half-open):
+    success closes the circuit, failure re-opens it with a doubled cooldown.
+    """
+    
+    def __init__(self, storage=None, window=50, failure_threshold=3, cooldown=60, max_cooldown=900):
+        self.storage = storage
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._providers = {}
+        self._lock = threading.Lock()
+        if storage is not None:
+            self._load()
+    
+    def order(self, provider_names):
+        """
+        Providers worth trying, fastest expected first
+        Providers without samples keep their preference position ahead of the
+        measured ones so they get measured too. When every circuit is open the
+        original list is returned rather than failing without trying.
+        """
+        now = time.time()
+        with self._lock:
+            usable = [name for name in provider_names if self._available(name, now)]
+            if not usable:
+                return list(provider_names)
+            return sorted(usable, key=lambda name: (self._expected_latency(name), provider_names.index(name)))
+    
+    def start(self, provider_name):
+        """Mark a request as started; an open circuit past its cooldown becomes the probe"""
+        with self._lock:
+            stats = self._stats(provider_name)
+            if stats['state'] == 'open' and time.time() - stats['opened_at'] >= stats['cooldown']:
+                stats['state'] = 'half_open'
+        return time.monotonic()
+    
+    def record(self, provider_name, started, ok):
+        """Record the outcome of a request started with start()"""
+        latency = time.monotonic() - started
+        with self._lock:
+            stats = self._stats(provider_name)
+            stats['outcomes'].append(1 if ok else 0)
+            if ok:
+                # Only successes count toward latency, fast failures are no bargain
+                stats['latencies'].append(round(latency, 3))
+                stats['consecutive_failures'] = 0
+                stats['state'] = 'closed'
+                stats['cooldown'] = self.cooldown
+            else:
+                stats['consecutive_failures'] += 1
+                if stats['state'] == 'half_open':
+                    # Probe failed, back off further
+                    stats['cooldown'] = min(stats['cooldown'] * 2, self.max_cooldown)
+                    self._open(stats)
+                elif stats['state'] == 'closed' and stats['consecutive_failures'] >= self.failure_threshold:
+                    self._open(stats)
+            self._save(provider_name, stats)
+    
+    def abandon(self, provider_name):
+        """A request was cancelled before finishing; a pending probe may be retried"""
+        with self._lock:
+            stats = self._stats(provider_name)
+            if stats['state'] == 'half_open':
+                stats['state'] = 'open'
+    
+    def snapshot(self):
+        """Latency percentiles, error rate and circuit state per provider"""
+        with self._lock:
+            return {
+                name: {
+                    'samples': len(stats['outcomes']),
+                    'p50': percentile(stats['latencies'], 50),
+                    'p95': percentile(stats['latencies'], 95),
+                    'error_rate': self._error_rate(stats),
+                    'state': stats['state'],
+                    'consecutive_failures': stats['consecutive_failures'],
+                }
+                for name, stats in self._providers.items()
+            }
+    
+    def _stats(self, provider_name):
+        stats = self._providers.get(provider_name)
+        if stats is None:
+            stats = self._providers[provider_name] = {
+                'latencies': deque(maxlen=self.window),
+                'outcomes': deque(maxlen=self.window),
+                'consecutive_failures': 0,
+                'state': 'closed',
+                'opened_at': None,
+                'cooldown': self.cooldown,
+            }
+        return stats
+    
+    def _available(self, provider_name, now):
+        stats = self._providers.get(provider_name)
+        if stats is None or stats['state'] == 'closed':
+            return True
+        if stats['state'] == 'half_open':
+            return False  # A probe is already in flight
+        return now - stats['opened_at'] >= stats['cooldown']
+    
+    def _expected_latency(self, provider_name):
+        """Median success latency divided by the success rate; 0 for unmeasured providers"""
+        stats = self._providers.get(provider_name)
+        if stats is None or not stats['outcomes']:
+            return 0.0
+        if not stats['latencies']:
+            return float('inf')
+        success_rate = max(1 - self._error_rate(stats), 0.05)
+        return percentile(stats['latencies'], 50) / success_rate
+    
+    @staticmethod
+    def _error_rate(stats):
+        outcomes = stats['outcomes']
+        return 1 - sum(outcomes) / len(outcomes) if outcomes else 0.0
+    
+    @staticmethod
+    def _open(stats):
+        stats['state'] = 'open'
+        stats['opened_at'] = time.time()
+    
+    def _load(self):
+        try:
+            rows = self.storage.get_provider_stats()
+        except Exception as e:
+            print(f"could not load provider stats: {e}")
+            return
+        for row in rows:
+            stats = self._stats(row['provider'])
+            stats['latencies'].extend(row['latencies'])
+            stats['outcomes'].extend(row['outcomes'])
+            stats['consecutive_failures'] = row['consecutive_failures']
+            # An interrupted probe counts as still open
+            stats['state'] = 'open' if row['state'] == 'half_open' else row['state']
+            stats['opened_at'] = row['opened_at']
+            stats['cooldown'] = row['cooldown'] or self.cooldown
+    
+    def _save(self, provider_name, stats):
+        if self.storage is None:
+            return
+        try:
+            self.storage.save_provider_stats(
+                provider_name, list(stats['latencies']), list(stats['outcomes']),
+                stats['consecutive_failures'], stats['state'], stats['opened_at'], stats['cooldown']
+            )
+        except Exception as e:
+            print(f"could not save provider stats: {e}")
+
+
+class RequestMetrics:
+    """
+    Per-call telemetry, written through the storage's background writer
+    Provider functions note() details such as time-to-first-byte and token
+    usage while a call runs; record() then saves one row for the call.
+    Details are kept per thread, since hedged calls run side by side.
+    """
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self._local = threading.local()
+    
+    def begin(self):
+        """Start a provider call on this thread; returns its start time"""
+        self._local.details = {}
+        return time.monotonic()
+    
+    def note(self, **details):
+        details_so_far = getattr(self._local, 'details', None)
+        if details_so_far is not None:
+            details_so_far.update(details)
+    
+    def record(self, provider, kind, started, outcome, prompt='', response='', fallback=False):
+        details = getattr(self._local, 'details', None) or {}
+        self._local.details = None
+        try:
+            self.storage.save_request_metric(
+                provider=provider, model=details.get('model') or PROVIDER_MODELS.get(provider),
+                kind=kind, outcome=outcome,
+                latency=time.monotonic() - started, ttfb=details.get('ttfb'),
+                prompt_chars=len(prompt), response_chars=len(response or ''),
+                prompt_tokens=details.get('prompt_tokens'),
+                completion_tokens=details.get('completion_tokens'), fallback=fallback
+            )
+        except Exception as e:
+            # Telemetry must never cost the user a result
+            print(f"could not record request metrics: {e}")
+    
+    @staticmethod
+    def chat_usage(usage):
+        """Token counts from an OpenAI-style usage object"""
+        usage = usage or {}
+        return {'prompt_tokens': usage.get('prompt_tokens'), 'completion_tokens': usage.get('completion_tokens')}
+    
+    @staticmethod
+    def gemini_usage(usage):
+        """Token counts from Gemini usageMetadata"""
+        usage = usage or {}
+        return {'prompt_tokens': usage.get('promptTokenCount'),
+                'completion_tokens': usage.get('candidatesTokenCount')}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a small sample, None when empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
 
 
 class APIClient:
     """Unified API client for all AI providers"""
     
-    def __init__(self):
-        self.storage = StorageManager()
+    def __init__(self, pool_size=4, idle_timeout=60, hedged=False, hedge_delay=2.0,
+                 cache_ttl=7 * 24 * 3600, cache_max_entries=500, storage=None, rate_limits=None,
+                 image_cache_bytes=200 * 1024 * 1024, base_urls=None):
+        self.storage = storage or StorageManager()
+        # Per-client host overrides, e.g. local stand-in servers for benchmarks
+        self.base_urls = {**PROVIDER_HOSTS, **(base_urls or {})}
+        self._keys_version = self.storage.keys_version
         self.api_keys = self.storage.get_api_keys()
+        # Requests rotate through every key saved for a provider
+        self.keys = KeyPool(self.storage)
+        self.keys.update(self.storage.get_api_key_pools())
+        self.http = SessionPool(pool_size=pool_size, idle_timeout=idle_timeout)
+        # Hedged mode races the next provider when the current one is slow
+        self.hedged = hedged
+        self.hedge_delay = hedge_delay
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # Response cache lives in SQLite, counters are per client
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Latency tracking and circuit breakers decide the provider order
+        self.health = ProviderHealth(self.storage)
+        # Identical concurrent requests share one provider call
+        self.flights = SingleFlight()
+        # Per-request telemetry for the Stats screen
+        self.metrics = RequestMetrics(self.storage)
+        # Downloaded images sit next to the database
+        self.images = ImageCache(os.path.join(os.path.dirname(os.path.abspath(self.storage.db_path)), 'images'),
+                                 max_bytes=image_cache_bytes)
+        # Batch generation paces each provider to its requests-per-minute limit times its keys
+        self.rate_limits = rate_limits or PROVIDER_RATE_LIMITS
+        self.rate_limiters = {name: TokenBucket(rpm) for name, rpm in self.rate_limits.items()}
+        self._scale_rate_limits()
+    
+    def connection_stats(self):
+        """Connection reuse counters per provider"""
+        return self.http.stats()
+    
+    def cache_stats(self):
+        """Response cache hit/miss counters"""
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / lookups if lookups else 0.0,
+        }
+    
+    def request_metrics(self):
+        """Per-provider latency percentiles, error rates and token usage from recorded calls"""
+        return self.storage.get_provider_metrics()
+    
+    def single_flight_stats(self):
+        """How many calls ran and how many piggybacked on an identical one in flight"""
+        return self.flights.stats()
+    
+    def key_usage(self):
+        """Requests, 429 responses and remaining cooldown per pooled API key"""
+        usage = self.storage.get_key_usage()
+        for row in usage:
+            row['benched_for'] = self.keys.benched_for(row['provider'], row['api_key'])
+        return usage
+    
+    def provider_health(self):
+        """Latency percentiles, error rates and circuit state per provider"""
+        return self.health.snapshot()
+    
+    def close(self):
+        """Release pooled HTTP connections and worker threads"""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        self.http.close()
+    
+    def has_text_keys(self):
+        """True if at least one text provider has an API key"""
+        self.refresh_keys()
+        return any(self.keys.size(name) for name, _ in self._text_providers())
+    
+    def reachable(self, timeout=3):
+        """
+        True if a TCP connection to any keyed text provider's host succeeds (i.e. we are online),
+        False if none does, None when no text provider has a key so there is nothing to reach
+        """
+        if not self.has_text_keys():
+            return None
+        for name, _ in self._text_providers():
+            if not self.keys.size(name):
+                continue
+            parts = urlsplit(self.base_urls[name])
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            try:
+                socket.create_connection((parts.hostname, port), timeout=timeout).close()
+                return True
+            except OSError:
+                continue
+        return False
     
     def refresh_keys(self):
-        """Refresh API keys from storage"""
-        self.api_keys = self.storage.get_api_keys()
+        """Refresh API keys from storage, only if Settings changed them since the last call"""
+        with tracing.span('refresh_keys'):
+            version = self.storage.keys_version
+            if version != self._keys_version:
+                self.api_keys = self.storage.get_api_keys()
+                self.keys.update(self.storage.get_api_key_pools())
+                self._scale_rate_limits()
+                self._keys_version = version
     
-    def generate_text(self, prompt, platform='General', tone='Professional'):
+    def _scale_rate_limits(self):
+        """Each key brings its own requests-per-minute allowance"""
+        for name, bucket in self.rate_limiters.items():
+            bucket.set_rate(self.rate_limits[name] * max(1, self.keys.size(name)))
+    
+    def generate_text(self, prompt, platform='General', tone='Professional', hedged=None,
+                      bypass_cache=False, cancel=None):
         """
         Generate text content using available AI providers
         Priority: Groq (fastest) -> Gemini -> OpenRouter
+        With hedged=True the next provider is started in parallel whenever the
+        current one has not answered within hedge_delay seconds.
+        bypass_cache=True skips the cache lookup (regenerate) but still stores the result.
+        Setting the cancel token (tasks.CancelToken) aborts with RequestCancelled.
+        Request parameters come from the platform and tone profiles. A post over
+        the platform's length limit is trimmed, or generated once more with the
+        limit spelled out when trimming would lose too much.
+        """
+        with tracing.span('generate_text', platform=platform, tone=tone):
+            self.refresh_keys()
+            
+            # Build enhanced prompt
+            with tracing.span('build_prompt'):
+                enhanced_prompt = self._build_prompt(prompt, platform, tone)
+            
+            params = generation_params(platform, tone)
+            content = self._generate(enhanced_prompt, params, hedged, bypass_cache, cancel)
+            max_chars = PLATFORM_MAX_CHARS.get(platform)
+            if max_chars is None or trim_post(content, max_chars) is not None:
+                return self.fit_length(content, platform)
+            
+            print(f"{platform} post is {len(content)} chars, limit {max_chars}; generating again")
+            tracing.instant('generate_text.too_long', platform=platform, chars=len(content))
+            content = self._generate(f"{enhanced_prompt}\n\nStay under {max_chars} characters.", params,
+                                     hedged, bypass_cache, cancel)
+            return self.fit_length(content, platform)
+    
+    @staticmethod
+    def fit_length(content, platform):
+        """
+        A post within the platform's length limit: trimmed where it costs the
+        least, or else cut at a word with an ellipsis (e.g. for streamed text,
+        which cannot be generated again once shown)
+        """
+        max_chars = PLATFORM_MAX_CHARS.get(platform)
+        if max_chars is None or len(content) <= max_chars:
+            return content
+        trimmed = trim_post(content, max_chars)
+        if trimmed is not None:
+            return trimmed
+        return content[:max_chars - 1].rsplit(None, 1)[0].rstrip() + '…'
+    
+    def generate_text_multi(self, prompt, platforms=MULTI_PLATFORMS, tone='Professional',
+                            hedged=None, bypass_cache=False, cancel=None):
+        """
+        Generate posts for several platforms with a single LLM request
+        Returns {platform: content}. Platforms missing from the JSON answer, or
+        whose post fails validation, are regenerated one by one with generate_text.
         """
         self.refresh_keys()
         
-        # Build enhanced prompt
-        enhanced_prompt = self._build_prompt(prompt, platform, tone)
+        platforms = list(platforms)
+        with tracing.span('build_prompt'):
+            enhanced_prompt = self._build_prompt(prompt, platforms, tone)
+        # Room for every platform's post in one answer, plus the JSON around them
+        params = dict(
+            DEFAULT_PARAMS, **TONE_PROFILES.get(tone, {}), json=True,
+            max_tokens=sum(generation_params(platform, tone)['max_tokens'] + 20 for platform in platforms)
+        )
+        
+        try:
+            raw = self._generate(enhanced_prompt, params, hedged, bypass_cache, cancel)
+            posts = self._parse_multi(raw, platforms)
+        except ValueError as e:
+            print(f"multi-platform answer unusable: {e}")
+            posts = {}
+        
+        results = {}
+        for platform in platforms:
+            content = posts.get(platform)
+            if content is None:
+                content = self.generate_text(prompt, platform, tone, hedged=hedged,
+                                             bypass_cache=bypass_cache, cancel=cancel)
+            results[platform] = content
+        return results
+    
+    @staticmethod
+    def _parse_multi(raw, platforms):
+        """Valid posts from a multi-platform JSON answer, keyed by platform"""
+        # Models sometimes wrap JSON in a markdown fence or add a preamble
+        start, end = raw.find('{'), raw.rfind('}')
+        if start == -1 or end < start:
+            raise ValueError("no JSON object in response")
+        try:
+            data = json.loads(raw[start:end + 1])
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        if not isinstance(data, dict):
+            raise ValueError("response is not a JSON object")
+        
+        by_name = {str(key).strip().lower(): value for key, value in data.items()}
+        posts = {}
+        for platform in platforms:
+            content = by_name.get(platform.lower())
+            if not isinstance(content, str) or not content.strip():
+                print(f"multi-platform answer has no usable {platform} post")
+                continue
+            content = content.strip()
+            max_chars = PLATFORM_MAX_CHARS.get(platform)
+            if max_chars and len(content) > max_chars:
+                trimmed = trim_post(content, max_chars)
+                if trimmed is None:
+                    print(f"multi-platform {platform} post is {len(content)} chars, limit {max_chars}")
+                    continue
+                content = trimmed
+            posts[platform] = content
+        return posts
+    
+    def _generate(self, enhanced_prompt, params, hedged=None, bypass_cache=False, cancel=None):
+        """Cache lookup, then provider dispatch (serial or hedged), then cache store"""
+        # Try providers in order of expected latency, skipping open circuits
+        providers = self._ordered(self._text_providers())
+        
+        if not bypass_cache:
+            cached = self._cache_lookup(enhanced_prompt, [name for name, _ in providers], params)
+            if cached is not None:
+                return cached
+        
+        def dispatch():
+            if self.hedged if hedged is None else hedged:
+                provider_name, content = self._generate_hedged(enhanced_prompt, providers, params, cancel)
+            else:
+                provider_name, content = self._generate_serial(enhanced_prompt, providers, params, cancel)
+            self._cache_store(enhanced_prompt, provider_name, content, params)
+            return content
+        
+        return self.flights.do(self._flight_key(enhanced_prompt, providers, params), dispatch, cancel)
+    
+    @staticmethod
+    def _flight_key(prompt, providers, params):
+        """Requests are identical when prompt, usable providers and parameters match"""
+        names = tuple(sorted(name for name, _ in providers))
+        return (prompt, names, tuple(sorted(params.items())))
+    
+    def generate_text_batch(self, jobs, max_workers=4, save_history=True):
+        """
+        Generate many posts concurrently, yielding (job, content, error) as each finishes
+        jobs are dicts with 'prompt' and optional 'platform'/'tone'. Each provider is
+        paced by a token bucket, and a job moves on to the next provider when the
+        preferred one is out of tokens, so load spreads across providers. Finished
+        posts are written to content_history in a single transaction at the end.
+        """
+        self.refresh_keys()
+        jobs = [{'platform': 'General', 'tone': 'Professional', **job} for job in jobs]
+        finished = []
         
-        # Try providers in order of preference
-        providers = [
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='batch')
+        futures = {executor.submit(self._generate_paced, job): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    content = future.result()
+                except Exception as e:
+                    yield job, None, e
+                    continue
+                finished.append((job['prompt'], content, job['platform'], job['tone']))
+                yield job, content, None
+        finally:
+            # Also reached when the caller stops iterating early
+            executor.shutdown(wait=True, cancel_futures=True)
+            if save_history and finished:
+                self.storage.save_posts(finished)
+    
+    def _generate_paced(self, job):
+        """generate_text for one batch job, waiting on provider rate limits"""
+        enhanced_prompt = self._build_prompt(job['prompt'], job['platform'], job['tone'])
+        params = generation_params(job['platform'], job['tone'])
+        providers = self._ordered(self._text_providers())
+        
+        cached = self._cache_lookup(enhanced_prompt, [name for name, _ in providers], params)
+        if cached is not None:
+            return self.fit_length(cached, job['platform'])
+        
+        def dispatch():
+            funcs = dict(providers)
+            remaining = [name for name, _ in providers]
+            errors = []
+            while remaining:
+                provider_name = self._acquire_provider(remaining)
+                try:
+                    content = self._timed(provider_name, funcs[provider_name], enhanced_prompt, None, params,
+                                          fallback=len(remaining) < len(providers))
+                except Exception as e:
+                    print(f"{provider_name} failed: {e}")
+                    errors.append(e)
+                    remaining.remove(provider_name)
+                    continue
+                self._cache_store(enhanced_prompt, provider_name, content, params)
+                return content
+            
+            raise providers_failed(errors)
+        
+        # Duplicate topics in one batch cost a single request; batches trim rather than regenerate
+        return self.fit_length(self.flights.do(self._flight_key(enhanced_prompt, providers, params), dispatch),
+                               job['platform'])
+    
+    def _acquire_provider(self, provider_names):
+        """Block until one of the providers (in preference order) has a rate-limit token and a usable key"""
+        while True:
+            waits = []
+            for name in provider_names:
+                key_wait = self.keys.wait_time(name)
+                if key_wait > 0:
+                    # Every key is sitting out a 429; waiting beats dropping the provider
+                    waits.append(key_wait)
+                    continue
+                bucket = self.rate_limiters.get(name)
+                wait_time = bucket.try_acquire() if bucket else 0
+                if wait_time == 0:
+                    return name
+                waits.append(wait_time)
+            time.sleep(min(waits))
+    
+    def _generate_serial(self, prompt, providers, params=None, cancel=None):
+        """Try providers one after another, returns (provider_name, content)"""
+        errors = []
+        for attempt, (provider_name, provider_func) in enumerate(providers):
+            try:
+                return provider_name, self._timed(provider_name, provider_func, prompt, cancel, params,
+                                                  fallback=attempt > 0)
+            except RequestCancelled:
+                raise
+            except Exception as e:
+                print(f"{provider_name} failed: {e}")
+                errors.append(e)
+                continue
+        
+        raise providers_failed(errors)
+    
+    def stream_text(self, prompt, platform='General', tone='Professional', cancel=None,
+                    bypass_cache=False):
+        """
+        Yield text chunks as the provider produces them
+        Falls back to the next provider only while nothing has been received yet,
+        since chunks already shown to the user cannot be taken back.
+        A cache hit is yielded as a single chunk. The text is not length checked;
+        pass the finished text through fit_length().
+        """
+        self.refresh_keys()
+        
+        with tracing.span('build_prompt'):
+            enhanced_prompt = self._build_prompt(prompt, platform, tone)
+        params = generation_params(platform, tone)
+        
+        streams = self._ordered([
+            ('groq', self._stream_with_groq),
+            ('gemini', self._stream_with_gemini),
+            ('openrouter', self._stream_with_openrouter),
+        ])
+        
+        if not bypass_cache:
+            cached = self._cache_lookup(enhanced_prompt, [name for name, _ in streams], params, kind='stream')
+            if cached is not None:
+                yield cached
+                return
+        
+        # A duplicate of a stream in flight gets the finished text as one chunk
+        flight_key = self._flight_key(enhanced_prompt, streams, params)
+        flight, leader = self.flights.join(flight_key)
+        while not leader:
+            try:
+                yield self.flights.wait(flight, cancel)
+                return
+            except _LeaderGone:
+                flight, leader = self.flights.join(flight_key)
+        
+        try:
+            content = yield from self._stream_providers(enhanced_prompt, streams, params, cancel)
+        except BaseException as e:
+            self.flights.finish(flight_key, flight, error=e)
+            raise
+        self.flights.finish(flight_key, flight, result=content)
+    
+    def _stream_providers(self, enhanced_prompt, streams, params, cancel=None):
+        """Stream from the first provider that produces a chunk; returns the full text"""
+        errors = []
+        for attempt, (provider_name, stream_func) in enumerate(streams):
+            started = False
+            chunks = []
+            start_time = self.health.start(provider_name)
+            metrics_started = self.metrics.begin()
+            
+            def record(outcome):
+                self.metrics.record(provider_name, 'stream', metrics_started, outcome, enhanced_prompt,
+                                    ''.join(chunks), fallback=attempt > 0)
+            
+            try:
+                for chunk in stream_func(enhanced_prompt, cancel, params):
+                    if not started:
+                        chunk = chunk.lstrip()
+                        if not chunk:
+                            continue
+                        started = True
+                        self.metrics.note(ttfb=time.monotonic() - metrics_started)
+                        tracing.instant('stream.first_chunk', provider=provider_name)
+                    chunks.append(chunk)
+                    yield chunk
+                if not started:
+                    raise Exception("empty response")
+            except RequestCancelled:
+                self.health.abandon(provider_name)
+                record('cancelled')
+                raise
+            except Exception as e:
+                self.health.record(provider_name, start_time, ok=False)
+                record('error')
+                if started:
+                    raise
+                print(f"{provider_name} failed: {e}")
+                errors.append(e)
+                continue
+            except GeneratorExit:
+                # The consumer stopped reading, not the provider's fault
+                self.health.abandon(provider_name)
+                record('cancelled')
+                raise
+            self.health.record(provider_name, start_time, ok=True)
+            record('ok')
+            content = ''.join(chunks).strip()
+            self._cache_store(enhanced_prompt, provider_name, content, params)
+            return content
+        
+        raise providers_failed(errors)
+    
+    def _cache_key(self, prompt, provider_name, params):
+        """Cache key from the whitespace-normalized built prompt, provider, model and request parameters"""
+        normalized = ' '.join(prompt.split())
+        options = json.dumps(params, sort_keys=True)
+        raw = f"{provider_name}\x1f{model_for(provider_name, params)}\x1f{options}\x1f{normalized}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+    
+    def _cache_lookup(self, prompt, provider_names, params, kind='text'):
+        """Cached content for the first provider (in preference order) that has one"""
+        started = self.metrics.begin()
+        with tracing.span('cache.lookup') as span:
+            keys = [self._cache_key(prompt, name, params) for name in provider_names]
+            hit = self.storage.get_cached_response(keys)
+            span.set(hit=hit is not None)
+        if hit is None:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self.metrics.record(hit[0], kind, started, 'cache_hit', prompt, hit[1])
+        return hit[1]
+    
+    def _cache_store(self, prompt, provider_name, content, params):
+        try:
+            self.storage.save_cached_response(
+                self._cache_key(prompt, provider_name, params), provider_name,
+                model_for(provider_name, params), content,
+                ttl=self.cache_ttl, max_entries=self.cache_max_entries
+            )
+        except Exception as e:
+            # A cache write failure must not cost the user their result
+            print(f"response cache write failed: {e}")
+    
+    def _ordered(self, providers):
+        """
+        Keep providers that have a key, in the order ProviderHealth recommends
+        Providers whose keys are all sitting out a 429 go last.
+        """
+        funcs = {name: func for name, func in providers if self.api_keys.get(name)}
+        ordered = sorted(self.health.order(list(funcs)), key=lambda name: not self.keys.available(name))
+        return [(name, funcs[name]) for name in ordered]
+    
+    def _timed(self, provider_name, provider_func, prompt, *args, fallback=False):
+        """Call a provider, feeding the outcome and latency to ProviderHealth and the metrics"""
+        start_time = self.health.start(provider_name)
+        started = self.metrics.begin()
+        try:
+            with tracing.span('provider', provider=provider_name, fallback=fallback):
+                result = provider_func(prompt, *args)
+        except RequestCancelled:
+            self.health.abandon(provider_name)
+            self.metrics.record(provider_name, 'text', started, 'cancelled', prompt, fallback=fallback)
+            raise
+        except Exception:
+            self.health.record(provider_name, start_time, ok=False)
+            self.metrics.record(provider_name, 'text', started, 'error', prompt, fallback=fallback)
+            raise
+        self.health.record(provider_name, start_time, ok=True)
+        self.metrics.record(provider_name, 'text', started, 'ok', prompt, result, fallback=fallback)
+        return result
+    
+    def _text_providers(self):
+        """Text providers in order of preference"""
+        return [
             ('groq', self._generate_with_groq),
             ('gemini', self._generate_with_gemini),
             ('openrouter', self._generate_with_openrouter),
         ]
+    
+    def _generate_hedged(self, prompt, providers, params=None, cancel=None):
+        """
+        Race providers: launch the next one on a slow or failed leader, first answer wins
+        Returns (provider_name, content).
+        """
+        if not providers:
+            raise Exception("No API keys configured or all providers failed. Please add API keys in Settings.")
         
-        for provider_name, provider_func in providers:
-            if self.api_keys.get(provider_name):
-                try:
-                    return provider_func(enhanced_prompt)
-                except Exception as e:
-                    print(f"{provider_name} failed: {e}")
+        executor = self._get_executor()
+        # Ends the race; also set when the caller cancels the whole request
+        race = cancel.child() if cancel is not None else CancelToken()
+        remaining = list(providers)
+        pending = {}
+        errors = []
+        next_hedge = None
+        
+        def launch():
+            nonlocal next_hedge
+            fallback = len(remaining) < len(providers)
+            provider_name, provider_func = remaining.pop(0)
+            future = executor.submit(self._timed, provider_name, provider_func, prompt, race, params,
+                                     fallback=fallback)
+            pending[future] = provider_name
+            next_hedge = time.monotonic() + self.hedge_delay
+        
+        launch()
+        try:
+            while pending:
+                if race.is_set():
+                    raise RequestCancelled('hedged request')
+                timeout = max(next_hedge - time.monotonic(), 0) if remaining else None
+                if cancel is not None:
+                    # Wake up regularly to notice the caller cancelling
+                    timeout = min(timeout, 0.2) if timeout is not None else 0.2
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    if remaining and time.monotonic() >= next_hedge:
+                        # Leader is too slow, hedge with the next provider
+                        launch()
                     continue
+                for future in done:
+                    provider_name = pending.pop(future)
+                    try:
+                        return provider_name, future.result()
+                    except RequestCancelled:
+                        raise
+                    except Exception as e:
+                        print(f"{provider_name} failed: {e}")
+                        errors.append(e)
+                        if remaining:
+                            launch()
+        finally:
+            # Losers are cancelled; in-flight ones drop their response unread
+            race.cancel()
+            for future in pending:
+                future.cancel()
         
-        raise Exception("No API keys configured or all providers failed. Please add API keys in Settings.")
+        raise providers_failed(errors, "All providers failed. Please check your API keys in Settings.")
     
-    def generate_image(self, prompt):
-        """Generate image using Bytez API"""
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='provider')
+            return self._executor
+    
+    def generate_image(self, prompt, cancel=None):
+        """
+        Generate image using Bytez API and download it to the image cache
+        Returns a dict with the image 'url', the cached file 'path' and a
+        'thumbnail' path; path and thumbnail are None if the download failed.
+        """
         self.refresh_keys()
         
-        bytez_key = self.api_keys.get('bytez')
-        if not bytez_key:
+        if not self.keys.size('bytez'):
             raise Exception("Bytez API key not configured")
         
-        return self._generate_with_bytez(prompt)
+        def generate():
+            started = self.metrics.begin()
+            try:
+                with tracing.span('provider', provider='bytez'):
+                    url = self._generate_with_bytez(prompt, cancel)
+            except RequestCancelled:
+                self.metrics.record('bytez', 'image', started, 'cancelled', prompt)
+                raise
+            except Exception:
+                self.metrics.record('bytez', 'image', started, 'error', prompt)
+                raise
+            self.metrics.record('bytez', 'image', started, 'ok', prompt, url)
+            path = thumbnail = None
+            try:
+                with tracing.span('image.download'):
+                    path = self._download_image(url, cancel)
+                with tracing.span('image.thumbnail'):
+                    thumbnail = self.images.thumbnail(path)
+            except Exception as e:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled('bytez')
+                # The URL is still worth showing
+                print(f"image download failed: {e}")
+            return {'url': url, 'path': path, 'thumbnail': thumbnail}
+        
+        return self.flights.do(('image', prompt), generate, cancel)
+    
+    def _download_image(self, url, cancel=None):
+        """Stream an image into the cache without holding it in memory"""
+        if not url.startswith(('http://', 'https://')):
+            raise Exception(f"no image URL in response: {url}")
+        response = self.http.get('bytez', url, cancel=cancel, stream=True, timeout=60)
+        with response:
+            response.raise_for_status()
+            return self.images.store(response.iter_content(chunk_size=64 * 1024), cancel)
+    
+    def image_stats(self):
+        """Image cache size and entry count"""
+        return self.images.stats()
     
     def _build_prompt(self, user_prompt, platform, tone):
-        """Build enhanced prompt with platform and tone context"""
-        platform_instructions = {
-            'Twitter': 'Create a concise, engaging tweet (max 280 characters). Use emojis strategically.',
-            'LinkedIn': 'Write a professional post suitable for LinkedIn. Focus on value and insights.',
-            'Instagram': 'Create an engaging caption perfect for Instagram. Use relevant hashtags.',
-            'Facebook': 'Write a friendly, shareable Facebook post that encourages engagement.',
-            'General': 'Create engaging social media content.'
-        }
+        """
+        Build enhanced prompt with platform and tone context
+        A list/tuple of platforms builds one prompt asking for a JSON object
+        with a post per platform.
+        """
+        tone_inst = TONE_INSTRUCTIONS.get(tone, '')
         
-        tone_instructions = {
-            'Professional': 'Use a professional, polished tone.',
-            'Casual': 'Write in a casual, conversational style.',
-            'Enthusiastic': 'Be energetic and enthusiastic!',
-            'Formal': 'Maintain a formal, authoritative tone.',
-            'Funny': 'Make it humorous and entertaining.',
-            'Inspirational': 'Be motivational and uplifting.'
-        }
+        if isinstance(platform, (list, tuple)):
+            platform_lines = '\n'.join(
+                f"- {name}: {PLATFORM_INSTRUCTIONS.get(name, PLATFORM_INSTRUCTIONS['General'])}"
+                for name in platform
+            )
+            keys = ', '.join(f'"{name}"' for name in platform)
+            return f"""Write one social media post for each platform below. {tone_inst}
+
+{platform_lines}
+
+Topic: {user_prompt}
+
+Respond with only a JSON object with the keys {keys}, each mapped to that platform's post text."""
         
-        platform_inst = platform_instructions.get(platform, platform_instructions['General'])
-        tone_inst = tone_instructions.get(tone, '')
+        platform_inst = PLATFORM_INSTRUCTIONS.get(platform, PLATFORM_INSTRUCTIONS['General'])
         
         return f"""{platform_inst} {tone_inst}
 
@@ -84,89 +1362,207 @@ Topic: {user_prompt}
 
 Generate the content now:"""
     
-    def _generate_with_groq(self, prompt):
-        """Generate text using Groq API (fastest)"""
-        url = "https://api.groq.com/openai/v1/chat/completions"
+    def _groq_request(self, prompt, api_key, params=None, stream=False):
+        params = params or DEFAULT_PARAMS
+        url = f"{self.base_urls['groq']}/openai/v1/chat/completions"
         headers = {
-            "Authorization": f"Bearer {self.api_keys['groq']}",
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
         data = {
-            "model": "llama-3.3-70b-versatile",  # Fast and good quality
+            "model": model_for('groq', params),
             "messages": [
                 {"role": "system", "content": "You are a professional social media content creator."},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.7,
-            "max_tokens": 500
+            "temperature": params['temperature'],
+            "max_tokens": params['max_tokens']
         }
-        
-        response = requests.post(url, headers=headers, json=data, timeout=30)
+        if params['json']:
+            data["response_format"] = {"type": "json_object"}
+        if params['stop']:
+            data["stop"] = list(params['stop'])
+        if stream:
+            data['stream'] = True
+        self.metrics.note(model=data['model'])
+        return url, headers, data
+    
+    def _generate_with_groq(self, prompt, cancel=None, params=None):
+        """Generate text using Groq API (fastest)"""
+        response = self._post_keyed('groq', lambda api_key: self._groq_request(prompt, api_key, params),
+                                    cancel, timeout=30)
         response.raise_for_status()
         
-        result = response.json()
+        with tracing.span('json.parse'):
+            result = response.json()
+        self.metrics.note(ttfb=response.elapsed.total_seconds(), **RequestMetrics.chat_usage(result.get('usage')))
         return result['choices'][0]['message']['content'].strip()
     
-    def _generate_with_gemini(self, prompt):
-        """Generate text using Google Gemini API"""
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={self.api_keys['gemini']}"
+    def _stream_with_groq(self, prompt, cancel=None, params=None):
+        """Stream text from Groq API"""
+        return self._stream_chat(
+            'groq', lambda api_key: self._groq_request(prompt, api_key, params, stream=True), cancel
+        )
+    
+    def _gemini_request(self, prompt, api_key, params=None, method='generateContent'):
+        params = params or DEFAULT_PARAMS
+        model = model_for('gemini', params)
+        url = f"{self.base_urls['gemini']}/v1beta/models/{model}:{method}?key={api_key}"
+        if method == 'streamGenerateContent':
+            url += '&alt=sse'
         headers = {"Content-Type": "application/json"}
         data = {
             "contents": [{
                 "parts": [{"text": prompt}]
             }],
             "generationConfig": {
-                "temperature": 0.7,
-                "maxOutputTokens": 500
+                "temperature": params['temperature'],
+                "maxOutputTokens": params['max_tokens']
             }
         }
-        
-        response = requests.post(url, headers=headers, json=data, timeout=30)
+        if params['json']:
+            data["generationConfig"]["responseMimeType"] = "application/json"
+        if params['stop']:
+            data["generationConfig"]["stopSequences"] = list(params['stop'])
+        self.metrics.note(model=model)
+        return url, headers, data
+    
+    def _generate_with_gemini(self, prompt, cancel=None, params=None):
+        """Generate text using Google Gemini API"""
+        response = self._post_keyed('gemini', lambda api_key: self._gemini_request(prompt, api_key, params),
+                                    cancel, timeout=30)
         response.raise_for_status()
         
-        result = response.json()
+        with tracing.span('json.parse'):
+            result = response.json()
+        self.metrics.note(ttfb=response.elapsed.total_seconds(),
+                          **RequestMetrics.gemini_usage(result.get('usageMetadata')))
         return result['candidates'][0]['content']['parts'][0]['text'].strip()
     
-    def _generate_with_openrouter(self, prompt):
-        """Generate text using OpenRouter API"""
-        url = "https://openrouter.ai/api/v1/chat/completions"
+    def _stream_with_gemini(self, prompt, cancel=None, params=None):
+        """Stream text from Gemini streamGenerateContent (SSE)"""
+        response = self._post_keyed(
+            'gemini', lambda api_key: self._gemini_request(prompt, api_key, params, method='streamGenerateContent'),
+            cancel, timeout=30, stream=True
+        )
+        with response:
+            response.raise_for_status()
+            for event in self._iter_sse(response, cancel):
+                if event.get('usageMetadata'):
+                    # Running totals, the last event has the final count
+                    self.metrics.note(**RequestMetrics.gemini_usage(event['usageMetadata']))
+                for candidate in event.get('candidates', []):
+                    for part in candidate.get('content', {}).get('parts', []):
+                        if part.get('text'):
+                            yield part['text']
+    
+    def _openrouter_request(self, prompt, api_key, params=None, stream=False):
+        params = params or DEFAULT_PARAMS
+        url = f"{self.base_urls['openrouter']}/api/v1/chat/completions"
         headers = {
-            "Authorization": f"Bearer {self.api_keys['openrouter']}",
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
         data = {
-            "model": "google/gemini-2.0-flash-exp:free",  # Free model
+            "model": model_for('openrouter', params),
             "messages": [
                 {"role": "system", "content": "You are a professional social media content creator."},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.7,
-            "max_tokens": 500
+            "temperature": params['temperature'],
+            "max_tokens": params['max_tokens']
         }
-        
-        response = requests.post(url, headers=headers, json=data, timeout=30)
+        if params['json']:
+            data["response_format"] = {"type": "json_object"}
+        if params['stop']:
+            data["stop"] = list(params['stop'])
+        if stream:
+            data['stream'] = True
+        self.metrics.note(model=data['model'])
+        return url, headers, data
+    
+    def _generate_with_openrouter(self, prompt, cancel=None, params=None):
+        """Generate text using OpenRouter API"""
+        response = self._post_keyed('openrouter', lambda api_key: self._openrouter_request(prompt, api_key, params),
+                                    cancel, timeout=30)
         response.raise_for_status()
         
-        result = response.json()
+        with tracing.span('json.parse'):
+            result = response.json()
+        self.metrics.note(ttfb=response.elapsed.total_seconds(), **RequestMetrics.chat_usage(result.get('usage')))
         return result['choices'][0]['message']['content'].strip()
     
-    def _generate_with_bytez(self, prompt):
-        """Generate image using Bytez API"""
-        url = "https://api.bytez.com/v1/image/generate"
+    def _stream_with_openrouter(self, prompt, cancel=None, params=None):
+        """Stream text from OpenRouter API"""
+        return self._stream_chat(
+            'openrouter', lambda api_key: self._openrouter_request(prompt, api_key, params, stream=True), cancel
+        )
+    
+    def _stream_chat(self, provider, build_request, cancel=None):
+        """Yield content deltas from an OpenAI-style chat completions stream"""
+        response = self._post_keyed(provider, build_request, cancel, timeout=30, stream=True)
+        with response:
+            response.raise_for_status()
+            for event in self._iter_sse(response, cancel):
+                # OpenRouter sends usage with the last event, Groq under x_groq
+                usage = event.get('usage') or (event.get('x_groq') or {}).get('usage')
+                if usage:
+                    self.metrics.note(**RequestMetrics.chat_usage(usage))
+                for choice in event.get('choices', []):
+                    text = (choice.get('delta') or {}).get('content')
+                    if text:
+                        yield text
+    
+    def _post_keyed(self, provider, build_request, cancel=None, **kwargs):
+        """
+        POST build_request(api_key) -> (url, headers, data) with the provider's next key
+        A 429 benches that key and the request is retried with the next one;
+        once every key is benched the 429 response is returned to the caller.
+        """
+        while True:
+            api_key = self.keys.acquire(provider)
+            url, headers, data = build_request(api_key)
+            response = self.http.post(provider, url, cancel=cancel, headers=headers, json=data, **kwargs)
+            if not self.keys.record(provider, api_key, response) or not self.keys.available(provider):
+                return response
+            response.close()
+    
+    @staticmethod
+    def _iter_sse(response, cancel=None):
+        """Yield the JSON payloads of a server-sent events response"""
+        for line in response.iter_lines():
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled(response.url)
+            # Skip keep-alive comments and blank separators
+            if not line.startswith(b'data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == b'[DONE]':
+                return
+            yield json.loads(payload)
+    
+    def _bytez_request(self, prompt, api_key):
+        url = f"{self.base_urls['bytez']}/v1/image/generate"
         headers = {
-            "Authorization": f"Bearer {self.api_keys['bytez']}",
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
         data = {
             "prompt": prompt,
-            "model": "flux-schnell",  # Fast and free
+            "model": PROVIDER_MODELS['bytez'],  # Fast and free
             "width": 1024,
             "height": 1024
         }
-        
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        return url, headers, data
+    
+    def _generate_with_bytez(self, prompt, cancel=None):
+        """Generate image using Bytez API"""
+        response = self._post_keyed('bytez', lambda api_key: self._bytez_request(prompt, api_key),
+                                    cancel, timeout=60)
         response.raise_for_status()
         
-        result = response.json()
+        with tracing.span('json.parse'):
+            result = response.json()
+        self.metrics.note(ttfb=response.elapsed.total_seconds())
         # Return the image URL
         return result.get('data', {}).get('url') or result.get('url') or 'Image generated (check API response format)'
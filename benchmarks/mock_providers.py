@@ -0,0 +1,196 @@
+"""
+Local stand-ins for the provider APIs
+Each MockProvider is a small threaded HTTP server that answers like Groq or
+OpenRouter chat completions, Gemini generateContent / streamGenerateContent
+or Bytez image generation, with configurable latency, error rate and
+streaming pace. Point APIClient(base_urls=...) at their base_url.
+"""
+
+import json
+import random
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+REPLY_TEXT = ('Big ideas start small. Ship the first version today, listen to the people using it, '
+              'and make tomorrow\'s version a little better. #buildinpublic #productivity')
+
+
+def solid_png(size=1024, rgb=(99, 102, 241)):
+    """A size x size single-colour PNG, built without Pillow"""
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+    
+    row = b'\x00' + bytes(rgb) * size
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(row * size, 9)) + chunk(b'IEND', b''))
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def handle_error(self, request, client_address):
+        # Clients hang up on purpose (cancelled streams, lost hedging races)
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class MockProvider:
+    """
+    One stand-in provider server
+    Every request waits latency seconds, or tail_latency with probability
+    tail_rate, and fails with error_status with probability error_rate.
+    Streams send one word every chunk_delay seconds.
+    """
+    
+    def __init__(self, name, latency=0.05, tail_latency=None, tail_rate=0.0, error_rate=0.0,
+                 error_status=500, chunk_delay=0.005, text=REPLY_TEXT, seed=0):
+        self.name = name
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_rate = tail_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chunk_delay = chunk_delay
+        self.text = text
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._image = None
+        self._server = _Server(('127.0.0.1', 0), self._handler())
+        self._thread = None
+    
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *exc):
+        self.stop()
+    
+    def _draw(self):
+        """(delay, fail) for one request, reproducible for a given seed"""
+        with self._lock:
+            self.requests += 1
+            slow = self.tail_latency is not None and self._random.random() < self.tail_rate
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return (self.tail_latency if slow else self.latency), fail
+    
+    def image_bytes(self):
+        if self._image is None:
+            self._image = solid_png()
+        return self._image
+    
+    def _handler(self):
+        provider = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes; without this, delayed ACKs add ~40 ms
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length) or b'{}')
+                delay, fail = provider._draw()
+                time.sleep(delay)
+                if fail:
+                    self._send_json({'error': {'message': 'mock failure'}}, provider.error_status)
+                    return
+                
+                if self.path.startswith('/v1/image/generate'):
+                    self._send_json({'data': {'url': f'{provider.base_url}/images/{provider.requests}.png'}})
+                elif ':streamGenerateContent' in self.path:
+                    self._stream(lambda word: {'candidates': [{'content': {'parts': [{'text': word}]}}]})
+                elif ':generateContent' in self.path:
+                    self._send_json({
+                        'candidates': [{'content': {'parts': [{'text': provider.text}]}}],
+                        'usageMetadata': {'promptTokenCount': 40, 'candidatesTokenCount': 30},
+                    })
+                elif body.get('stream'):
+                    self._stream(lambda word: {'choices': [{'delta': {'content': word}}]}, done=True)
+                else:
+                    self._send_json({
+                        'choices': [{'message': {'role': 'assistant', 'content': provider.text}}],
+                        'usage': {'prompt_tokens': 40, 'completion_tokens': 30},
+                    })
+            
+            def do_GET(self):
+                if not self.path.startswith('/images/'):
+                    self._send_json({'error': 'not found'}, 404)
+                    return
+                data = provider.image_bytes()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def _send_json(self, payload, status=200):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def _stream(self, event_for, done=False):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                words = provider.text.split(' ')
+                for i, word in enumerate(words):
+                    text = word if i == len(words) - 1 else word + ' '
+                    self._write_chunk(b'data: ' + json.dumps(event_for(text)).encode() + b'\n\n')
+                    time.sleep(provider.chunk_delay)
+                if done:
+                    self._write_chunk(b'data: [DONE]\n\n')
+                self._write_chunk(b'')
+            
+            def _write_chunk(self, data):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+        
+        return Handler
+
+
+def start_providers(**overrides):
+    """
+    Start one mock server per provider and return {name: MockProvider}
+    overrides maps a provider name to MockProvider keyword arguments.
+    """
+    providers = {}
+    for seed, name in enumerate(('groq', 'gemini', 'openrouter', 'bytez')):
+        options = {'seed': seed, **overrides.get(name, {})}
+        providers[name] = MockProvider(name, **options).start()
+    return providers
+
+
+def stop_providers(providers):
+    for provider in providers.values():
+        provider.stop()
@@ -0,0 +1,316 @@
+"""
+Benchmark suite for APIClient and StorageManager
+Runs every provider call against local mock servers (benchmarks/mock_providers.py)
+and writes the results as JSON, so runs can be compared over time.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --quick
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+# Run from anywhere: the app modules live one directory up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from api_client import APIClient, ProviderHealth, percentile  # noqa: E402
+from storage import StorageManager  # noqa: E402
+from benchmarks.mock_providers import start_providers, stop_providers  # noqa: E402
+
+
+# Synthetic history text: word frequencies follow Zipf's law like real text,
+# so search terms range from near-universal to rare
+VOCABULARY_SIZE = 5000
+# Search terms by frequency rank: a common word AND a less common one
+SEARCH_RANKS = (20, 300)
+
+# Mock provider behaviour per scenario (MockProvider keyword arguments);
+# fresh_health forgets provider health before every request
+LATENCY_SCENARIOS = {
+    'serial': {
+        'client': {},
+        'providers': {},
+    },
+    # Every Groq call fails; with health reset Groq stays first and its circuit
+    # never opens, so every request pays for the failed call before Gemini
+    'fallback': {
+        'client': {},
+        'providers': {'groq': {'error_rate': 1.0}},
+        'fresh_health': True,
+    },
+    # One Groq call in five stalls for a second
+    'tail_serial': {
+        'client': {},
+        'providers': {'groq': {'tail_latency': 1.0, 'tail_rate': 0.2}},
+    },
+    'tail_hedged': {
+        'client': {'hedged': True, 'hedge_delay': 0.15},
+        'providers': {'groq': {'tail_latency': 1.0, 'tail_rate': 0.2}},
+    },
+}
+
+DEFAULT_LATENCIES = {
+    'groq': {'latency': 0.05},
+    'gemini': {'latency': 0.08},
+    'openrouter': {'latency': 0.12},
+    'bytez': {'latency': 0.2},
+}
+
+
+def summarize(samples, errors=0):
+    """Latency distribution in milliseconds"""
+    return {
+        'count': len(samples),
+        'errors': errors,
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3) if samples else None,
+        'p50_ms': _ms(percentile(samples, 50)),
+        'p90_ms': _ms(percentile(samples, 90)),
+        'p99_ms': _ms(percentile(samples, 99)),
+        'max_ms': _ms(max(samples) if samples else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def measure_rate(fn, min_seconds=1.0, min_ops=20):
+    """Call fn repeatedly for at least min_seconds and min_ops; returns ops/sec"""
+    ops = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        ops += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds and ops >= min_ops:
+            return round(ops / elapsed, 1)
+
+
+def make_client(workdir, providers, **options):
+    """APIClient on a fresh database whose providers all point at the mock servers"""
+    storage = StorageManager(os.path.join(workdir, f'client-{time.perf_counter_ns()}.db'))
+    storage.save_api_keys({name: f'mock-{name}-key' for name in providers})
+    base_urls = {name: provider.base_url for name, provider in providers.items()}
+    return APIClient(storage=storage, base_urls=base_urls, **options)
+
+
+def with_providers(overrides, run):
+    options = {name: {**DEFAULT_LATENCIES[name], **overrides.get(name, {})} for name in DEFAULT_LATENCIES}
+    providers = start_providers(**options)
+    try:
+        return run(providers)
+    finally:
+        stop_providers(providers)
+
+
+def bench_generate(workdir, requests_per_scenario):
+    """generate_text latency per scenario; unique prompts so cache and coalescing stay out of it"""
+    results = {}
+    for name, scenario in LATENCY_SCENARIOS.items():
+        def run(providers):
+            client = make_client(workdir, providers, **scenario['client'])
+            samples, errors, fallbacks = [], 0, 0
+            for i in range(requests_per_scenario):
+                if scenario.get('fresh_health'):
+                    client.health = ProviderHealth()
+                before = sum(p.requests for p in providers.values())
+                started = time.perf_counter()
+                try:
+                    client.generate_text(f'{name} post number {i}', bypass_cache=True)
+                except Exception:
+                    errors += 1
+                    continue
+                samples.append(time.perf_counter() - started)
+                # More than one provider call for one request means it fell back (or hedged)
+                if sum(p.requests for p in providers.values()) - before > 1:
+                    fallbacks += 1
+            client.close()
+            result = summarize(samples, errors)
+            result['fallbacks'] = fallbacks
+            result['provider_requests'] = {n: p.requests for n, p in providers.items() if p.requests}
+            return result
+        results[name] = with_providers(scenario['providers'], run)
+        print(f"generate_text/{name}: p50 {results[name]['p50_ms']} ms, p99 {results[name]['p99_ms']} ms, "
+              f"{results[name]['fallbacks']} fallbacks", file=sys.stderr)
+    return results
+
+
+def bench_stream(workdir, requests):
+    """stream_text time to first chunk and to the full text"""
+    def run(providers):
+        client = make_client(workdir, providers)
+        first, total, errors = [], [], 0
+        for i in range(requests):
+            started = time.perf_counter()
+            try:
+                for n, chunk in enumerate(client.stream_text(f'stream post number {i}', bypass_cache=True)):
+                    if n == 0:
+                        first.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+                continue
+            total.append(time.perf_counter() - started)
+        client.close()
+        return {'first_chunk': summarize(first, errors), 'complete': summarize(total, errors)}
+    result = with_providers({}, run)
+    print(f"stream_text: first chunk p50 {result['first_chunk']['p50_ms']} ms", file=sys.stderr)
+    return result
+
+
+def bench_batch(workdir, jobs, max_workers):
+    """generate_text_batch throughput with rate limits lifted"""
+    def run(providers):
+        client = make_client(workdir, providers, rate_limits={name: 10 ** 6 for name in providers})
+        batch = [{'prompt': f'batch post number {i}'} for i in range(jobs)]
+        errors = 0
+        started = time.perf_counter()
+        for job, content, error in client.generate_text_batch(batch, max_workers=max_workers, save_history=True):
+            errors += error is not None
+        elapsed = time.perf_counter() - started
+        client.close()
+        return {
+            'jobs': jobs,
+            'max_workers': max_workers,
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'jobs_per_sec': round(jobs / elapsed, 1),
+            'provider_requests': {n: p.requests for n, p in providers.items() if p.requests},
+        }
+    result = with_providers({}, run)
+    print(f"generate_text_batch: {result['jobs_per_sec']} jobs/s", file=sys.stderr)
+    return result
+
+
+def make_vocabulary(rng):
+    """(words, cumulative Zipf weights) of made-up lowercase words"""
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 10))))
+    words = sorted(words)
+    rng.shuffle(words)
+    weights, total = [], 0.0
+    for rank in range(1, len(words) + 1):
+        total += 1 / rank
+        weights.append(total)
+    return words, weights
+
+
+def fill_history(storage, rows, rng, vocabulary, chunk=10000):
+    """Insert rows of varied history through save_posts; returns rows/sec"""
+    words, weights = vocabulary
+    started = time.perf_counter()
+    for offset in range(0, rows, chunk):
+        posts = []
+        for i in range(offset, min(rows, offset + chunk)):
+            text = ' '.join(rng.choices(words, cum_weights=weights, k=40))
+            prompt = ' '.join(rng.choices(words, cum_weights=weights, k=6))
+            posts.append((prompt, text, rng.choice(('Twitter', 'LinkedIn', 'Instagram', 'Facebook')), 'Casual'))
+        storage.save_posts(posts)
+    return round(rows / (time.perf_counter() - started), 1)
+
+
+def bench_storage(workdir, row_counts, seed):
+    """save_post / get_history throughput at each history size"""
+    results = {}
+    for rows in row_counts:
+        rng = random.Random(seed)
+        vocabulary = make_vocabulary(rng)
+        search_query = ' '.join(vocabulary[0][rank - 1] for rank in SEARCH_RANKS)
+        storage = StorageManager(os.path.join(workdir, f'history-{rows}.db'))
+        result = {'fill_rows_per_sec': fill_history(storage, rows, rng, vocabulary)}
+        
+        # Queue a burst of writes, then wait for the writer to commit them
+        burst = 2000
+        started = time.perf_counter()
+        for i in range(burst):
+            storage.save_post(f'bench prompt {i}', 'bench content ' * 20, 'Twitter', 'Casual')
+        enqueued = time.perf_counter() - started
+        storage.flush()
+        committed = time.perf_counter() - started
+        result['save_post_enqueue_ops_per_sec'] = round(burst / enqueued, 1)
+        result['save_post_committed_ops_per_sec'] = round(burst / committed, 1)
+        
+        result['get_history_50_ops_per_sec'] = measure_rate(lambda: storage.get_history(50))
+        
+        def walk_pages(pages=10):
+            cursor = None
+            for _ in range(pages):
+                page, cursor = storage.get_history_page(before=cursor)
+                if cursor is None:
+                    break
+        result['get_history_page_x10_ops_per_sec'] = measure_rate(walk_pages)
+        result['search_history_ops_per_sec'] = measure_rate(lambda: storage.search_history(search_query))
+        
+        storage.db.close()
+        results[str(rows)] = result
+        print(f"storage/{rows} rows: get_history {result['get_history_50_ops_per_sec']} ops/s", file=sys.stderr)
+    return results
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'args': vars(args),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='small sizes for a smoke run')
+    parser.add_argument('--requests', type=int, default=100, help='generate_text calls per scenario')
+    parser.add_argument('--batch', type=int, default=200, help='jobs in the batch benchmark')
+    parser.add_argument('--workers', type=int, default=8, help='batch max_workers')
+    parser.add_argument('--rows', default='1000,100000,1000000', help='history sizes, comma separated')
+    parser.add_argument('--only', choices=('generate', 'stream', 'batch', 'storage'), action='append',
+                        help='run only these benchmarks (repeatable)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+    if args.quick:
+        args.requests, args.batch, args.rows = 20, 50, '1000,10000'
+    
+    selected = set(args.only or ('generate', 'stream', 'batch', 'storage'))
+    workdir = tempfile.mkdtemp(prefix='aicg-bench-')
+    results = {}
+    try:
+        if 'generate' in selected:
+            results['generate_text'] = bench_generate(workdir, args.requests)
+        if 'stream' in selected:
+            results['stream_text'] = bench_stream(workdir, args.requests)
+        if 'batch' in selected:
+            results['generate_text_batch'] = bench_batch(workdir, args.batch, args.workers)
+        if 'storage' in selected:
+            row_counts = [int(rows) for rows in args.rows.split(',') if rows]
+            results['storage'] = bench_storage(workdir, row_counts, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    report = json.dumps({'meta': metadata(args), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,12 +15,15 @@ source.dir = .
 # (list) Source files to include (let empty to include all the files)
 source.include_exts = py,png,jpg,kv,atlas,txt,md
 
+# (list) List of directory to exclude (let empty to not exclude anything)
+source.exclude_dirs = benchmarks, tests
+
 # (str) Application versioning (method 1)
 version = 1.0.0
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy==2.3.0,requests,pyjnius,android
+requirements = python3,kivy==2.3.0,requests,pillow,pyjnius,android
 
 # (str) Supported orientation (landscape, sensorLandscape, portrait or all)
 orientation = portrait
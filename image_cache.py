@@ -0,0 +1,193 @@
+"""
+On-disk image cache
+Generated images are stored once per content hash, with small thumbnails for
+display, and the least recently used ones are evicted past a total size cap.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+THUMB_SUFFIX = '.thumb.jpg'
+
+_pil_image = False  # Not imported yet
+
+
+def _load_pil():
+    """Pillow's Image module, imported on first thumbnail rather than at startup; None without Pillow"""
+    global _pil_image
+    if _pil_image is False:
+        try:
+            from PIL import Image
+        except ImportError:
+            # Without Pillow no thumbnails are made and the full image is shown
+            Image = None
+        _pil_image = Image
+    return _pil_image
+
+
+def _sniff_extension(head):
+    """File extension from the first bytes of an image"""
+    if head.startswith(b'\x89PNG'):
+        return '.png'
+    if head.startswith(b'\xff\xd8'):
+        return '.jpg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return '.gif'
+    return '.img'
+
+
+class ImageCache:
+    """Content-addressed image files under root, capped at max_bytes in total"""
+    
+    def __init__(self, root, max_bytes=200 * 1024 * 1024, thumb_size=256):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.thumb_size = thumb_size
+        self._tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # digest -> [image path, bytes on disk], least recently used first
+        self._entries = OrderedDict()
+        self._total = 0
+        self._scan()
+    
+    def _scan(self):
+        """Rebuild the LRU order from file modification times"""
+        found = {}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if not os.path.isfile(path):
+                continue
+            digest = name.split('.', 1)[0]
+            stat = os.stat(path)
+            entry = found.setdefault(digest, [None, 0, 0])
+            if not name.endswith(THUMB_SUFFIX):
+                entry[0] = path
+                entry[2] = stat.st_mtime
+            entry[1] += stat.st_size
+        
+        for digest, (path, size, mtime) in sorted(found.items(), key=lambda item: item[1][2]):
+            if path is None:
+                # Thumbnail left behind by an interrupted eviction
+                self._remove_files(digest)
+                continue
+            self._entries[digest] = [path, size]
+            self._total += size
+        
+        # Partial downloads from a previous run
+        for name in os.listdir(self._tmp_dir):
+            try:
+                os.remove(os.path.join(self._tmp_dir, name))
+            except OSError:
+                pass
+    
+    def store(self, chunks, cancel=None):
+        """
+        Write an iterable of byte chunks to the cache and return the image path
+        The bytes are hashed while they stream to a temporary file, so nothing
+        is held in memory and identical images end up as a single file.
+        """
+        digest = hashlib.sha256()
+        head = b''
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    if cancel is not None and cancel.is_set():
+                        raise Exception('image download cancelled')
+                    if len(head) < 16:
+                        head += chunk[:16]
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        
+        digest = digest.hexdigest()
+        path = os.path.join(self.root, digest + _sniff_extension(head))
+        with self._lock:
+            if digest in self._entries:
+                os.remove(tmp_path)
+                self._touch(digest)
+                return self._entries[digest][0]
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            self._entries[digest] = [path, size]
+            self._total += size
+            self._evict()
+        return path
+    
+    def thumbnail(self, path):
+        """Path of a downscaled JPEG for the image at path, or None without Pillow"""
+        Image = _load_pil()
+        if Image is None:
+            return None
+        digest = os.path.basename(path).split('.', 1)[0]
+        thumb_path = os.path.join(self.root, digest + THUMB_SUFFIX)
+        if os.path.exists(thumb_path):
+            return thumb_path
+        
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp_dir)
+        os.close(fd)
+        try:
+            with Image.open(path) as image:
+                # JPEGs can be decoded straight at a reduced scale
+                image.draft('RGB', (self.thumb_size, self.thumb_size))
+                image.thumbnail((self.thumb_size, self.thumb_size))
+                image.convert('RGB').save(tmp_path, 'JPEG', quality=85)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        
+        with self._lock:
+            if digest not in self._entries:
+                # Evicted while the thumbnail was being made
+                os.remove(tmp_path)
+                return None
+            os.replace(tmp_path, thumb_path)
+            size = os.path.getsize(thumb_path)
+            self._entries[digest][1] += size
+            self._total += size
+        return thumb_path
+    
+    def get(self, path):
+        """path if it is still cached (marking it recently used), else None"""
+        digest = os.path.basename(path).split('.', 1)[0]
+        with self._lock:
+            if digest not in self._entries:
+                return None
+            self._touch(digest)
+            return self._entries[digest][0]
+    
+    def stats(self):
+        with self._lock:
+            return {'images': len(self._entries), 'bytes': self._total, 'max_bytes': self.max_bytes}
+    
+    def _touch(self, digest):
+        self._entries.move_to_end(digest)
+        try:
+            # Persist the recency for the next _scan
+            os.utime(self._entries[digest][0])
+        except OSError:
+            pass
+    
+    def _evict(self):
+        # The newest image always stays, even when it alone exceeds the cap
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            digest, (path, size) = self._entries.popitem(last=False)
+            self._total -= size
+            self._remove_files(digest, path)
+    
+    def _remove_files(self, digest, path=None):
+        for doomed in (path, os.path.join(self.root, digest + THUMB_SUFFIX)):
+            if doomed is None:
+                continue
+            try:
+                os.remove(doomed)
+            except OSError:
+                pass
@@ -0,0 +1,164 @@
+"""
+Background draining of the offline job queue
+Generation requests that could not reach a provider are kept in the
+job_queue table (StorageManager.enqueue_job). JobWorker runs them several at
+a time, backs off per job on failure, pauses the whole queue while the
+device is offline, and writes each result to history as it finishes.
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tasks import CancelToken
+
+
+class JobQueued(Exception):
+    """A request could not run now and was put in the job queue instead"""
+
+
+class JobWorker:
+    """
+    Drains StorageManager's job queue through an APIClient
+    Failed jobs are retried after base_delay * 2^attempts seconds (capped at
+    max_delay, with jitter) and marked failed after max_attempts, or at once
+    when no text provider has a key. While no provider host can be connected
+    to the queue is paused instead, without using up attempts.
+    on_change(counts) is called after every job finishes.
+    """
+    
+    def __init__(self, client, storage, max_workers=4, base_delay=5, max_delay=600,
+                 max_attempts=8, on_change=None):
+        self.client = client
+        self.storage = storage
+        self.max_workers = max_workers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.on_change = on_change
+        self._cancel = CancelToken()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._running = 0
+        self._offline_until = 0.0
+        self._offline_delay = base_delay
+        self._thread = None
+    
+    @property
+    def offline(self):
+        """True while the queue is paused because no provider was reachable"""
+        return time.monotonic() < self._offline_until
+    
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='job-worker', daemon=True)
+            self._thread.start()
+        return self
+    
+    def wake(self):
+        """Look at the queue now, e.g. after enqueueing a job"""
+        self._wake.set()
+    
+    def resume(self):
+        """Retry right away even if offline, e.g. when the app comes back to the foreground"""
+        with self._lock:
+            self._offline_until = 0.0
+        self._wake.set()
+    
+    def stop(self, timeout=None):
+        """Stop claiming jobs; jobs in flight are cancelled and go back to pending"""
+        self._cancel.cancel()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def counts(self):
+        return self.storage.get_job_counts()
+    
+    def _run(self):
+        # Jobs that were running when the app last stopped
+        self.storage.requeue_jobs()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job') as executor:
+            while not self._cancel.is_set():
+                self._wake.clear()
+                with self._lock:
+                    free = self.max_workers - self._running
+                jobs = self.storage.claim_jobs(free) if free and not self.offline else []
+                for job in jobs:
+                    with self._lock:
+                        self._running += 1
+                    executor.submit(self._run_job, job)
+                if not jobs:
+                    self._wake.wait(self._idle_timeout())
+    
+    def _idle_timeout(self):
+        """Seconds to sleep until the next job is due or the offline pause ends"""
+        if self.offline:
+            return self._offline_until - time.monotonic()
+        due = self.storage.next_job_due()
+        if due is None:
+            return None  # Nothing queued, sleep until woken
+        return min(max(due - time.time(), 0.05), self.max_delay)
+    
+    def _run_job(self, job):
+        try:
+            posts = self._generate(job)
+        except Exception as e:
+            self._failed(job, e)
+        else:
+            self.storage.complete_job(job['id'], posts)
+            with self._lock:
+                self._offline_delay = self.base_delay
+        finally:
+            with self._lock:
+                self._running -= 1
+            self._wake.set()
+            if self.on_change is not None:
+                try:
+                    self.on_change(self.counts())
+                except Exception as e:
+                    print(f"job queue listener failed: {e}")
+    
+    def _generate(self, job):
+        """Run one job; returns its (prompt, content, platform, tone) history rows"""
+        prompt, platform, tone = job['prompt'], job['platform'], job['tone']
+        if platform == 'All':
+            posts = self.client.generate_text_multi(prompt=prompt, tone=tone, cancel=self._cancel)
+            return [(prompt, content, name, tone) for name, content in posts.items()]
+        content = self.client.generate_text(prompt=prompt, platform=platform, tone=tone, cancel=self._cancel)
+        return [(prompt, content, platform, tone)]
+    
+    def _failed(self, job, error):
+        # Imported here like in main.py, to keep api_client out of app startup
+        from api_client import ProvidersUnreachable
+        
+        if self._cancel.is_set():
+            # Shutting down: not the job's fault
+            self.storage.retry_job(job['id'], 0, count_attempt=False)
+            return
+        
+        if not self.client.has_text_keys():
+            # Retrying cannot help until keys are added in Settings
+            print(f"job {job['id']} failed: {error}")
+            self.storage.fail_job(job['id'], str(error))
+            return
+        
+        if isinstance(error, ProvidersUnreachable) and self.client.reachable() is False:
+            # Offline: pause everything and probe again with growing gaps
+            with self._lock:
+                # Jobs failing side by side extend the same pause only once
+                if not self.offline:
+                    self._offline_until = time.monotonic() + self._offline_delay
+                    self._offline_delay = min(self._offline_delay * 2, self.max_delay)
+            self.storage.retry_job(job['id'], 0, error='offline', count_attempt=False)
+            return
+        
+        attempts = job['attempts'] + 1
+        if attempts >= self.max_attempts:
+            print(f"job {job['id']} failed for good: {error}")
+            self.storage.fail_job(job['id'], str(error))
+            return
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        # Jitter keeps jobs queued together from retrying in lockstep
+        self.storage.retry_job(job['id'], delay * random.uniform(0.5, 1.0), error=str(error))
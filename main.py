@@ -3,6 +3,14 @@ AI Content Generator - Mobile App
 A productivity app for generating AI-powered social media content
 """
 
+import os
+import re
+import time
+import threading
+
+# Startup timing starts before Kivy is imported
+_started = time.perf_counter()
+
 from kivy.app import App
 from kivy.uix.screenmanager import ScreenManager, Screen
 from kivy.uix.boxlayout import BoxLayout
@@ -12,15 +20,26 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.spinner import Spinner
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.gridlayout import GridLayout
+from kivy.uix.image import AsyncImage
+from kivy.uix.switch import Switch
+from kivy.uix.popup import Popup
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.properties import StringProperty, NumericProperty
 from kivy.core.window import Window
-from kivy.utils import get_color_from_hex
+from kivy.utils import get_color_from_hex, escape_markup
 from kivy.graphics import Color, RoundedRectangle
 from kivy.animation import Animation
 from kivy.clock import Clock
-import threading
 
-from api_client import APIClient
 from storage import StorageManager
+from tasks import TaskRunner
+from job_queue import JobWorker, JobQueued
+import tracing
+
+# api_client (and with it requests) is imported on first use, see AIContentGeneratorApp.api_client
+IMPORT_TIME = time.perf_counter() - _started
 
 # Set window background color
 Window.clearcolor = get_color_from_hex('#0A0E27')
@@ -48,11 +67,71 @@ class ModernButton(Button):
         self.rect.size = self.size
 
 
+class HistoryItem(RecycleDataViewBehavior, BoxLayout):
+    """History row; RecycleView re-binds a handful of these to whatever rows are visible"""
+    post_id = NumericProperty(0)
+    meta = StringProperty('')
+    preview = StringProperty('')
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.orientation = 'vertical'
+        self.padding = 10
+        self.spacing = 5
+        
+        with self.canvas.before:
+            Color(rgba=get_color_from_hex('#1E293B'))
+            self.rect = RoundedRectangle(pos=self.pos, size=self.size, radius=[10])
+        self.bind(pos=self.update_rect, size=self.update_rect)
+        
+        # Metadata
+        meta_label = Label(
+            font_size='11sp',
+            size_hint_y=None,
+            height=20,
+            color=get_color_from_hex('#94A3B8')
+        )
+        self.add_widget(meta_label)
+        
+        # Content preview
+        preview_label = Label(
+            markup=True,
+            font_size='12sp',
+            size_hint_y=None,
+            height=60,
+            color=get_color_from_hex('#E0E7FF'),
+            text_size=(Window.width - 60, None)
+        )
+        self.add_widget(preview_label)
+        
+        self.bind(meta=meta_label.setter('text'), preview=preview_label.setter('text'))
+    
+    def on_touch_up(self, touch):
+        # A tap opens the full post; a drag is the list scrolling
+        if self.collide_point(*touch.pos) and abs(touch.y - touch.oy) < 10 and self.post_id:
+            App.get_running_app().root.get_screen('history').open_post(self.post_id)
+            return True
+        return super().on_touch_up(touch)
+    
+    def update_rect(self, *args):
+        self.rect.pos = self.pos
+        self.rect.size = self.size
+
+
 class HomeScreen(Screen):
     """Main content generation screen"""
+    
+    # Seconds between result redraws while a response is streaming in
+    STREAM_REFRESH_INTERVAL = 1 / 15
+    # How alike (0-1) an earlier prompt must be for its post to be offered instead
+    SIMILARITY_THRESHOLD = 0.8
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.api_client = APIClient()
+        self.storage = App.get_running_app().storage
+        # A new generation supersedes (cancels) the one still in flight
+        self.tasks = App.get_running_app().tasks
+        self.last_text_request = None
         
         layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
         
@@ -102,7 +181,7 @@ class HomeScreen(Screen):
         
         self.platform_spinner = Spinner(
             text='Twitter',
-            values=('Twitter', 'LinkedIn', 'Instagram', 'Facebook', 'General'),
+            values=('Twitter', 'LinkedIn', 'Instagram', 'Facebook', 'General', 'All'),
             size_hint_y=None,
             height=44,
             background_color=get_color_from_hex('#1E293B'),
@@ -144,15 +223,29 @@ class HomeScreen(Screen):
         
         layout.add_widget(btn_layout)
         
+        # Requests waiting in the offline job queue
+        self.queue_label = Label(
+            text='',
+            font_size='12sp',
+            size_hint_y=None,
+            height=20,
+            color=get_color_from_hex('#94A3B8')
+        )
+        layout.add_widget(self.queue_label)
+        
         # Result display
-        result_label = Label(
+        self.result_label = Label(
             text='Result',
             font_size='16sp',
             size_hint_y=None,
             height=30,
             color=get_color_from_hex('#E0E7FF')
         )
-        layout.add_widget(result_label)
+        layout.add_widget(self.result_label)
+        
+        # Generated image preview; AsyncImage decodes through Kivy's Loader thread
+        self.result_image = AsyncImage(size_hint_y=None, height=0, opacity=0, fit_mode='contain')
+        layout.add_widget(self.result_image)
         
         scroll = ScrollView(size_hint=(1, 1))
         self.result_text = TextInput(
@@ -168,7 +261,9 @@ class HomeScreen(Screen):
         layout.add_widget(scroll)
         
         # Bottom buttons
-        bottom_layout = GridLayout(cols=2, spacing=10, size_hint_y=None, height=50)
+        bottom_layout = GridLayout(cols=3, spacing=10, size_hint_y=None, height=50)
+        # Disabled with the generate buttons while history is being upgraded
+        self.nav_layout = bottom_layout
         
         settings_btn = ModernButton(text='⚙️ Settings')
         settings_btn.background_color = get_color_from_hex('#475569')
@@ -180,10 +275,19 @@ class HomeScreen(Screen):
         history_btn.bind(on_press=self.go_to_history)
         bottom_layout.add_widget(history_btn)
         
+        stats_btn = ModernButton(text='📊 Stats')
+        stats_btn.background_color = get_color_from_hex('#475569')
+        stats_btn.bind(on_press=self.go_to_stats)
+        bottom_layout.add_widget(stats_btn)
+        
         layout.add_widget(bottom_layout)
         
         self.add_widget(layout)
     
+    @property
+    def api_client(self):
+        return App.get_running_app().api_client
+    
     def generate_text(self, instance):
         """Generate text content using AI"""
         prompt = self.prompt_input.text.strip()
@@ -192,22 +296,78 @@ class HomeScreen(Screen):
             return
         
         self.result_text.text = '⏳ Generating amazing content...'
-        self.generate_text_btn.disabled = True
-        
-        def generate():
-            try:
-                content = self.api_client.generate_text(
-                    prompt=prompt,
-                    platform=self.platform_spinner.text,
-                    tone=self.tone_spinner.text
-                )
-                Clock.schedule_once(lambda dt: self.show_result(content))
-            except Exception as e:
-                Clock.schedule_once(lambda dt: self.show_error(str(e)))
-            finally:
-                Clock.schedule_once(lambda dt: setattr(self.generate_text_btn, 'disabled', False))
-        
-        threading.Thread(target=generate, daemon=True).start()
+        self.result_label.text = 'Result'
+        self.show_image(None)
+        platform = self.platform_spinner.text
+        tone = self.tone_spinner.text
+        # Asking again for what is already on screen means "regenerate"
+        regenerate = (prompt, platform, tone) == self.last_text_request
+        
+        if platform == 'All':
+            self.generate_all_platforms(prompt, tone, regenerate)
+            return
+        if regenerate:
+            self.stream_generation(prompt, platform, tone, regenerate=True)
+            return
+        
+        # A near-identical earlier prompt answers instantly from history
+        def found(matches):
+            if matches:
+                self.show_similar(matches[0], prompt, platform, tone)
+            else:
+                self.stream_generation(prompt, platform, tone)
+        
+        self.tasks.submit(
+            lambda cancel: self.storage.find_similar(prompt, platform, tone, self.SIMILARITY_THRESHOLD, limit=1),
+            key='generate', on_result=found,
+            on_error=lambda error: self.stream_generation(prompt, platform, tone)
+        )
+    
+    def stream_generation(self, prompt, platform, tone, regenerate=False):
+        """Stream a new post into the result box"""
+        # Chunks arrive on the worker thread; the UI picks them up in batches
+        chunks = []
+        
+        def flush(dt):
+            if chunks:
+                with tracing.span('ui.stream_redraw', chunks=len(chunks)):
+                    self.result_text.text = ''.join(chunks)
+        
+        flush_event = Clock.schedule_interval(flush, self.STREAM_REFRESH_INTERVAL)
+        
+        @self.queue_when_offline(prompt, platform, tone)
+        def generate(cancel):
+            for chunk in self.api_client.stream_text(prompt=prompt, platform=platform, tone=tone,
+                                                     bypass_cache=regenerate, cancel=cancel):
+                chunks.append(chunk)
+            # Already on screen, so an overlong post is trimmed rather than generated again
+            return self.api_client.fit_length(''.join(chunks).strip(), platform)
+        
+        def shown(content):
+            flush_event.cancel()
+            self.last_text_request = (prompt, platform, tone)
+            self.show_result(content, prompt, platform, tone)
+        
+        def failed(error):
+            flush_event.cancel()
+            self.show_error(error)
+        
+        self.tasks.submit(generate, key='generate', on_result=shown, on_error=failed,
+                          on_cancel=flush_event.cancel)
+    
+    def generate_all_platforms(self, prompt, tone, regenerate=False):
+        """Generate a post for every platform with one multi-platform request"""
+        @self.queue_when_offline(prompt, 'All', tone)
+        def generate(cancel):
+            return self.api_client.generate_text_multi(prompt=prompt, tone=tone, bypass_cache=regenerate,
+                                                       cancel=cancel)
+        
+        def shown(posts):
+            self.last_text_request = (prompt, 'All', tone)
+            self.show_multi_result(posts, prompt, tone)
+        
+        self.tasks.submit(generate, key='generate', on_result=shown,
+                          on_error=self.show_error)
     
     def generate_image(self, instance):
         """Generate image using AI"""
@@ -217,47 +377,153 @@ class HomeScreen(Screen):
             return
         
         self.result_text.text = '🎨 Creating your image...'
-        self.generate_image_btn.disabled = True
-        
-        def generate():
-            try:
-                image_url = self.api_client.generate_image(prompt)
-                Clock.schedule_once(lambda dt: self.show_result(f'✅ Image generated!\n\n🔗 {image_url}\n\n(Image URL - long press to copy)'))
-            except Exception as e:
-                Clock.schedule_once(lambda dt: self.show_error(str(e)))
-            finally:
-                Clock.schedule_once(lambda dt: setattr(self.generate_image_btn, 'disabled', False))
-        
-        threading.Thread(target=generate, daemon=True).start()
-    
-    def show_result(self, content):
-        """Display generated content"""
-        self.result_text.text = content
-        # Save to history
-        storage = StorageManager()
-        storage.save_post(
-            prompt=self.prompt_input.text,
-            content=content,
-            platform=self.platform_spinner.text,
-            tone=self.tone_spinner.text
+        self.result_label.text = 'Result'
+        # The history row describes this request, whatever the inputs say when it finishes
+        platform = self.platform_spinner.text
+        tone = self.tone_spinner.text
+        
+        def shown(image):
+            self.show_result(f'✅ Image generated!\n\n🔗 {image["url"]}\n\n(Image URL - long press to copy)',
+                             prompt, platform, tone, image_path=image['path'])
+            # The thumbnail is enough for the preview; the full image stays on disk
+            self.show_image(image['thumbnail'] or image['path'])
+        
+        def generate(cancel):
+            return self.api_client.generate_image(prompt, cancel)
+        
+        # Shares the key with text generation: both fill the same result box
+        self.tasks.submit(generate, key='generate', on_result=shown,
+                          on_error=self.show_error)
+    
+    def show_similar(self, match, prompt, platform, tone):
+        """Offer an earlier post for a near-identical prompt; asking again generates a fresh one"""
+        self.result_text.text = match['content']
+        self.result_label.text = (f"♻️ From History ({match['similarity']:.0%} match) · "
+                                  f"tap Generate Text again for a fresh one")
+        # Already in history, so nothing is saved; the next identical request regenerates
+        self.last_text_request = (prompt, platform, tone)
+    
+    def queue_when_offline(self, prompt, platform, tone):
+        """
+        Decorate a task so a text request that cannot reach any provider is queued, not lost
+        The task then fails with JobQueued, which show_error reports. While the
+        job worker knows the device is offline, the request is queued at once.
+        Other failures (no API keys, rejected keys, provider errors) are raised as they are.
+        """
+        def decorate(generate):
+            def run(cancel):
+                # The client is loaded by now; api_client stays out of startup imports
+                from api_client import ProvidersUnreachable
+                jobs = App.get_running_app().jobs
+                if jobs is None or not jobs.offline or not self.api_client.has_text_keys():
+                    try:
+                        return generate(cancel)
+                    except ProvidersUnreachable:
+                        if cancel.is_set():
+                            raise
+                self.storage.enqueue_job(prompt, platform, tone)
+                if jobs is not None:
+                    jobs.wake()
+                    counts = jobs.counts()
+                    Clock.schedule_once(lambda dt: self.show_job_counts(counts))
+                raise JobQueued("You're offline. The request is queued and will be generated "
+                                "(and saved to History) once the connection is back.")
+            return run
+        return decorate
+    
+    def show_job_counts(self, counts):
+        """Summarize the job queue under the generate buttons"""
+        waiting = counts.get('pending', 0) + counts.get('running', 0)
+        parts = []
+        if waiting:
+            parts.append(f'📥 {waiting} queued')
+        if counts.get('failed'):
+            parts.append(f"{counts['failed']} failed")
+        self.queue_label.text = ' · '.join(parts)
+    
+    def show_result(self, content, prompt, platform, tone, image_path=None):
+        """Display generated content and save it to history under the request it answers"""
+        with tracing.span('ui.show_result'):
+            self.result_text.text = content
+            if image_path is None:
+                self.show_image(None)
+            # Save to history
+            ticket = self.storage.save_post(
+                prompt=prompt,
+                content=content,
+                platform=platform,
+                tone=tone,
+                image_path=image_path
+            )
+        self.confirm_saved([ticket])
+    
+    def show_upgrading(self, upgrading):
+        """Keep everything that touches the database disabled while history is migrated"""
+        for widget in (self.generate_text_btn, self.generate_image_btn, self.nav_layout):
+            widget.disabled = upgrading
+        self.result_text.text = ('⏳ Upgrading history…' if upgrading
+                                 else 'Your generated content will appear here...')
+    
+    def show_image(self, path):
+        """Show a cached image above the result, or hide the preview when path is None"""
+        if path is None:
+            self.result_image.source = ''
+            self.result_image.height = 0
+            self.result_image.opacity = 0
+            return
+        self.result_image.source = path
+        self.result_image.height = 200
+        self.result_image.opacity = 1
+    
+    def show_multi_result(self, posts, prompt, tone):
+        """Display one post per platform and save each as its own history row"""
+        self.result_text.text = '\n\n'.join(
+            f'— {platform} —\n{content}' for platform, content in posts.items()
         )
+        tickets = [
+            self.storage.save_post(
+                prompt=prompt,
+                content=content,
+                platform=platform,
+                tone=tone
+            )
+            for platform, content in posts.items()
+        ]
+        self.confirm_saved(tickets)
+    
+    def confirm_saved(self, tickets):
+        """History is written in the background; say so if one of these posts could not be saved"""
+        def not_saved(saved):
+            if not saved:
+                self.result_label.text = '⚠️ Could not save this post to History'
+        
+        self.tasks.submit(lambda cancel: all(self.storage.wait_saved(ticket) for ticket in tickets),
+                          on_result=not_saved)
     
     def show_error(self, error):
         """Display error message"""
+        self.show_image(None)
+        if isinstance(error, JobQueued):
+            self.result_text.text = f'📥 {error}'
+            return
         self.result_text.text = f'❌ Error: {error}\n\nPlease check your API keys in Settings.'
     
     def go_to_settings(self, instance):
-        self.manager.current = 'settings'
+        App.get_running_app().show_screen('settings')
     
     def go_to_history(self, instance):
-        self.manager.current = 'history'
+        App.get_running_app().show_screen('history')
+    
+    def go_to_stats(self, instance):
+        App.get_running_app().show_screen('stats')
 
 
 class SettingsScreen(Screen):
     """Settings screen for API keys"""
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.storage = StorageManager()
+        self.storage = App.get_running_app().storage
+        self.tasks = App.get_running_app().tasks
         
         layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
         
@@ -286,7 +552,7 @@ class SettingsScreen(Screen):
             color=get_color_from_hex('#E0E7FF')
         ))
         self.gemini_key = TextInput(
-            hint_text='Enter your Gemini API key',
+            hint_text='Enter your Gemini API key (separate several with commas)',
             multiline=False,
             size_hint_y=None,
             height=44,
@@ -305,7 +571,7 @@ class SettingsScreen(Screen):
             color=get_color_from_hex('#E0E7FF')
         ))
         self.groq_key = TextInput(
-            hint_text='Enter your Groq API key',
+            hint_text='Enter your Groq API key (separate several with commas)',
             multiline=False,
             size_hint_y=None,
             height=44,
@@ -324,7 +590,7 @@ class SettingsScreen(Screen):
             color=get_color_from_hex('#E0E7FF')
         ))
         self.openrouter_key = TextInput(
-            hint_text='Enter your OpenRouter API key',
+            hint_text='Enter your OpenRouter API key (separate several with commas)',
             multiline=False,
             size_hint_y=None,
             height=44,
@@ -343,7 +609,7 @@ class SettingsScreen(Screen):
             color=get_color_from_hex('#E0E7FF')
         ))
         self.bytez_key = TextInput(
-            hint_text='Enter your Bytez API key',
+            hint_text='Enter your Bytez API key (separate several with commas)',
             multiline=False,
             size_hint_y=None,
             height=44,
@@ -353,6 +619,87 @@ class SettingsScreen(Screen):
         )
         api_layout.add_widget(self.bytez_key)
         
+        # Requests and 429s per key, so a worn-out key is easy to spot
+        self.key_usage_label = Label(
+            text='',
+            font_size='12sp',
+            size_hint_y=None,
+            color=get_color_from_hex('#94A3B8'),
+            halign='left'
+        )
+        self.key_usage_label.bind(
+            width=lambda label, width: setattr(label, 'text_size', (width, None)),
+            texture_size=lambda label, size: setattr(label, 'height', size[1])
+        )
+        api_layout.add_widget(self.key_usage_label)
+        
+        # Performance tracing, for capturing a slow session on the device
+        api_layout.add_widget(Label(
+            text='Performance trace',
+            font_size='14sp',
+            size_hint_y=None,
+            height=30,
+            color=get_color_from_hex('#E0E7FF')
+        ))
+        trace_layout = GridLayout(cols=2, spacing=10, size_hint_y=None, height=44)
+        self.trace_switch = Switch(active=tracing.is_enabled())
+        self.trace_switch.bind(active=self.toggle_tracing)
+        trace_layout.add_widget(self.trace_switch)
+        self.export_trace_btn = ModernButton(text='📤 Export trace')
+        self.export_trace_btn.height = 44
+        self.export_trace_btn.background_color = get_color_from_hex('#475569')
+        self.export_trace_btn.bind(on_press=self.export_trace)
+        trace_layout.add_widget(self.export_trace_btn)
+        api_layout.add_widget(trace_layout)
+        self.trace_status = Label(
+            text='',
+            font_size='12sp',
+            size_hint_y=None,
+            height=40,
+            color=get_color_from_hex('#94A3B8')
+        )
+        self.trace_status.bind(width=lambda label, width: setattr(label, 'text_size', (width, None)))
+        api_layout.add_widget(self.trace_status)
+        
+        # History backup: export to / import from a JSON Lines or CSV file
+        api_layout.add_widget(Label(
+            text='History file (.jsonl or .csv)',
+            font_size='14sp',
+            size_hint_y=None,
+            height=30,
+            color=get_color_from_hex('#E0E7FF')
+        ))
+        self.history_file = TextInput(
+            text=os.path.join(os.path.dirname(os.path.abspath(self.storage.db_path)), 'exports', 'history.jsonl'),
+            multiline=False,
+            size_hint_y=None,
+            height=44,
+            background_color=get_color_from_hex('#1E293B'),
+            foreground_color=get_color_from_hex('#F1F5F9')
+        )
+        api_layout.add_widget(self.history_file)
+        history_layout = GridLayout(cols=2, spacing=10, size_hint_y=None, height=44)
+        export_history_btn = ModernButton(text='📤 Export history')
+        export_history_btn.height = 44
+        export_history_btn.background_color = get_color_from_hex('#475569')
+        export_history_btn.bind(on_press=self.export_history)
+        history_layout.add_widget(export_history_btn)
+        import_history_btn = ModernButton(text='📥 Import history')
+        import_history_btn.height = 44
+        import_history_btn.background_color = get_color_from_hex('#475569')
+        import_history_btn.bind(on_press=self.import_history)
+        history_layout.add_widget(import_history_btn)
+        api_layout.add_widget(history_layout)
+        self.history_status = Label(
+            text='',
+            font_size='12sp',
+            size_hint_y=None,
+            height=40,
+            color=get_color_from_hex('#94A3B8')
+        )
+        self.history_status.bind(width=lambda label, width: setattr(label, 'text_size', (width, None)))
+        api_layout.add_widget(self.history_status)
+        
         scroll.add_widget(api_layout)
         layout.add_widget(scroll)
         
@@ -377,33 +724,128 @@ class SettingsScreen(Screen):
     
     def load_settings(self):
         """Load saved API keys"""
-        keys = self.storage.get_api_keys()
-        self.gemini_key.text = keys.get('gemini', '')
-        self.groq_key.text = keys.get('groq', '')
-        self.openrouter_key.text = keys.get('openrouter', '')
-        self.bytez_key.text = keys.get('bytez', '')
+        pools = self.storage.get_api_key_pools()
+        self.gemini_key.text = ', '.join(pools.get('gemini', []))
+        self.groq_key.text = ', '.join(pools.get('groq', []))
+        self.openrouter_key.text = ', '.join(pools.get('openrouter', []))
+        self.bytez_key.text = ', '.join(pools.get('bytez', []))
+        self.load_key_usage()
+    
+    def load_key_usage(self):
+        """Per-key counters, read off the UI thread (reading waits for queued writes)"""
+        self.tasks.submit(lambda cancel: self.storage.get_key_usage(), key='key_usage',
+                          on_result=self.show_key_usage)
+    
+    def show_key_usage(self, usage):
+        lines = [
+            f"{row['provider']} …{row['api_key'][-4:]}: {row['requests']} requests, "
+            f"{row['rate_limited']} rate limited"
+            for row in usage if row['requests']
+        ]
+        self.key_usage_label.text = '\n'.join(lines)
+    
+    @staticmethod
+    def split_keys(text):
+        """Keys typed into one field, separated by commas or whitespace"""
+        return [key for key in re.split(r'[,\s]+', text) if key]
     
     def save_settings(self, instance):
         """Save API keys"""
         self.storage.save_api_keys({
-            'gemini': self.gemini_key.text,
-            'groq': self.groq_key.text,
-            'openrouter': self.openrouter_key.text,
-            'bytez': self.bytez_key.text
+            'gemini': self.split_keys(self.gemini_key.text),
+            'groq': self.split_keys(self.groq_key.text),
+            'openrouter': self.split_keys(self.openrouter_key.text),
+            'bytez': self.split_keys(self.bytez_key.text)
         })
         # Show feedback
         instance.text = '✅ Saved!'
         Clock.schedule_once(lambda dt: setattr(instance, 'text', '💾 Save'), 2)
     
+    def toggle_tracing(self, switch, active):
+        """Start or stop recording spans and UI frame times"""
+        app = App.get_running_app()
+        if active:
+            tracing.enable()
+            app.start_frame_sampling()
+            self.trace_status.text = 'Recording… reproduce the slow action, then export.'
+        else:
+            tracing.disable()
+            app.stop_frame_sampling()
+            self.trace_status.text = f'Stopped, {tracing.event_count()} events recorded.'
+    
+    def export_trace(self, instance):
+        """Write the recorded events as a Chrome trace next to the database"""
+        if not tracing.event_count():
+            self.trace_status.text = 'Nothing recorded yet, switch tracing on first.'
+            return
+        trace_dir = os.path.join(os.path.dirname(os.path.abspath(self.storage.db_path)), 'traces')
+        path = os.path.join(trace_dir, time.strftime('trace-%Y%m%d-%H%M%S.json'))
+        try:
+            tracing.export(path)
+        except OSError as e:
+            self.trace_status.text = f'❌ Export failed: {e}'
+            return
+        tracing.clear()
+        self.trace_status.text = f'Saved {path} (open in ui.perfetto.dev)'
+    
+    def export_history(self, instance):
+        """Stream all history into the file named above, off the UI thread"""
+        path = self.history_file.text.strip()
+        if not path:
+            return
+        
+        def export(cancel):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            return self.storage.export_history(
+                path, cancel=cancel,
+                progress=lambda fraction: self.show_history_progress(f'Exporting… {fraction:.0%}'))
+        
+        self.history_status.text = 'Exporting…'
+        self.tasks.submit(export, key='history_file',
+                          on_result=lambda rows: self.set_history_status(f'✅ Exported {rows:,} posts to {path}'),
+                          on_error=lambda error: self.set_history_status(f'❌ Export failed: {error}'))
+    
+    def import_history(self, instance):
+        """Append the posts of the file named above to history, off the UI thread"""
+        path = self.history_file.text.strip()
+        if not path:
+            return
+        stages = {'import': 'Importing', 'index': 'Indexing for search'}
+        
+        def run(cancel):
+            rows = self.storage.import_history(
+                path, cancel=cancel,
+                progress=lambda stage, fraction: self.show_history_progress(f'{stages[stage]}… {fraction:.0%}'))
+            # Imported prompts join the near-duplicate index now rather than on later lookups
+            self.storage.index_similarity(cancel=cancel)
+            return rows
+        
+        self.history_status.text = 'Importing…'
+        self.tasks.submit(run, key='history_file',
+                          on_result=lambda rows: self.set_history_status(f'✅ Imported {rows:,} posts'),
+                          on_error=lambda error: self.set_history_status(f'❌ Import failed: {error}'))
+    
+    def set_history_status(self, text):
+        self.history_status.text = text
+    
+    def show_history_progress(self, text):
+        """Called on the worker thread; the label is updated on the next frame"""
+        Clock.schedule_once(lambda dt: self.set_history_status(text))
+    
     def go_back(self, instance):
         self.manager.current = 'home'
 
 
 class HistoryScreen(Screen):
     """History of generated content"""
+    
+    # Rows fetched per keyset page
+    PAGE_SIZE = 30
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.storage = StorageManager()
+        self.storage = App.get_running_app().storage
+        self.tasks = App.get_running_app().tasks
         
         layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
         
@@ -428,12 +870,45 @@ class HistoryScreen(Screen):
         
         layout.add_widget(header_layout)
         
-        # History list
-        scroll = ScrollView(size_hint=(1, 1))
-        self.history_layout = BoxLayout(orientation='vertical', spacing=10, size_hint_y=None)
-        self.history_layout.bind(minimum_height=self.history_layout.setter('height'))
-        scroll.add_widget(self.history_layout)
-        layout.add_widget(scroll)
+        # Search box, re-queried shortly after the user stops typing
+        self.search_input = TextInput(
+            hint_text='🔍 Search your posts...',
+            multiline=False,
+            size_hint_y=None,
+            height=44,
+            background_color=get_color_from_hex('#1E293B'),
+            foreground_color=get_color_from_hex('#F1F5F9'),
+            cursor_color=get_color_from_hex('#6366F1')
+        )
+        self.search_trigger = Clock.create_trigger(self.load_history, 0.25)
+        self.search_input.bind(text=lambda instance, text: self.search_trigger())
+        layout.add_widget(self.search_input)
+        
+        # Shown instead of the list when there is nothing to list
+        self.empty_label = Label(
+            font_size='14sp',
+            color=get_color_from_hex('#94A3B8'),
+            size_hint_y=None,
+            height=0
+        )
+        layout.add_widget(self.empty_label)
+        
+        # History list: view widgets are recycled, rows are fetched a page at a time
+        self.history_list = RecycleView(size_hint=(1, 1))
+        self.history_list.viewclass = HistoryItem
+        list_layout = RecycleBoxLayout(
+            orientation='vertical',
+            spacing=10,
+            size_hint_y=None,
+            default_size=(None, 120),
+            default_size_hint=(1, None)
+        )
+        list_layout.bind(minimum_height=list_layout.setter('height'))
+        self.history_list.add_widget(list_layout)
+        self.history_list.bind(scroll_y=self.on_history_scroll)
+        layout.add_widget(self.history_list)
+        self.next_cursor = None
+        self.loading_more = False
         
         # Back button
         back_btn = ModernButton(text='← Back')
@@ -447,52 +922,202 @@ class HistoryScreen(Screen):
         """Load history when screen is entered"""
         self.load_history()
     
-    def load_history(self, instance=None):
-        """Load and display history"""
-        self.history_layout.clear_widgets()
-        posts = self.storage.get_history()
-        
-        if not posts:
-            self.history_layout.add_widget(Label(
-                text='No history yet.\nGenerate some content to see it here!',
-                font_size='14sp',
-                color=get_color_from_hex('#94A3B8'),
-                size_hint_y=None,
-                height=100
-            ))
+    def load_history(self, *args):
+        """Load the first page of history, or search results while a query is typed"""
+        # Reads wait for queued writes and share the database with imports, so they run off the UI thread
+        self.tasks.cancel('history_more')
+        self.loading_more = False
+        query = self.search_input.text.strip()
+        if query:
+            # A first page still loading would overwrite the results
+            self.tasks.cancel('history_page')
+            # The key supersedes: the next keystroke pause cancels a query still running.
+            # Control characters survive markup escaping and mark the matches
+            self.tasks.submit(lambda cancel: self.storage.search_history(query, highlight=('\x02', '\x03')),
+                              key='history_search',
+                              on_result=lambda posts: self.show_history(posts, None, query),
+                              on_error=lambda error: print(f"history search failed: {error}"))
             return
+        self.tasks.cancel('history_search')
+        self.tasks.submit(lambda cancel: self.storage.get_history_page(limit=self.PAGE_SIZE), key='history_page',
+                          on_result=lambda page: self.show_history(*page, query),
+                          on_error=lambda error: print(f"could not load history: {error}"))
+    
+    def show_history(self, posts, next_cursor, query):
+        """Replace the list with a first page or with search results"""
+        self.next_cursor = next_cursor
+        self.history_list.data = [self.history_item(post) for post in posts]
+        self.history_list.scroll_y = 1
         
-        for post in posts:
-            item = BoxLayout(orientation='vertical', size_hint_y=None, height=120, padding=10, spacing=5)
-            
-            with item.canvas.before:
-                Color(rgba=get_color_from_hex('#1E293B'))
-                item.rect = RoundedRectangle(pos=item.pos, size=item.size, radius=[10])
-            item.bind(pos=lambda i, p: setattr(i.rect, 'pos', p), size=lambda i, s: setattr(i.rect, 'size', s))
-            
-            # Metadata
-            meta = Label(
-                text=f"{post['platform']} • {post['tone']} • {post['created_at'][:16]}",
-                font_size='11sp',
-                size_hint_y=None,
-                height=20,
-                color=get_color_from_hex('#94A3B8')
-            )
-            item.add_widget(meta)
-            
-            # Content preview
-            content_preview = post['content'][:100] + ('...' if len(post['content']) > 100 else '')
-            content = Label(
-                text=content_preview,
-                font_size='12sp',
-                size_hint_y=None,
-                height=60,
-                color=get_color_from_hex('#E0E7FF'),
-                text_size=(Window.width - 60, None)
+        if posts:
+            self.empty_label.text = ''
+            self.empty_label.height = 0
+        else:
+            self.empty_label.text = (f'No posts match "{query}".' if query
+                                     else 'No history yet.\nGenerate some content to see it here!')
+            self.empty_label.height = 100
+    
+    def on_history_scroll(self, instance, scroll_y):
+        """Fetch the next page as the list nears its end"""
+        if self.next_cursor is None or self.loading_more or scroll_y > 0.1:
+            return
+        self.loading_more = True
+        before = self.next_cursor
+        
+        def loaded(page):
+            posts, self.next_cursor = page
+            self.loading_more = False
+            self.history_list.data.extend(self.history_item(post) for post in posts)
+        
+        def failed(error):
+            print(f"could not load more history: {error}")
+            self.loading_more = False
+        
+        self.tasks.submit(lambda cancel: self.storage.get_history_page(before=before, limit=self.PAGE_SIZE),
+                          key='history_more', on_result=loaded, on_error=failed)
+    
+    @staticmethod
+    def history_item(post):
+        """RecycleView data for one history or search row"""
+        if 'snippet' in post:
+            preview = escape_markup(post['snippet']).replace(
+                '\x02', '[b][color=#A5B4FC]').replace('\x03', '[/color][/b]')
+        else:
+            preview = escape_markup(post['preview'] + ('...' if post['truncated'] else ''))
+        return {
+            'post_id': post['id'],
+            'meta': f"{post['platform']} • {post['tone']} • {post['created_at'][:16]}",
+            'preview': preview,
+        }
+    
+    def open_post(self, post_id):
+        """Show one post in full; its body is only read (and inflated) now, off the UI thread"""
+        self.tasks.submit(lambda cancel: self.storage.get_post(post_id), key='history_post',
+                          on_result=self.show_post,
+                          on_error=lambda error: print(f"could not open post {post_id}: {error}"))
+    
+    def show_post(self, post):
+        if post is None:
+            return
+        body = TextInput(
+            text=post['content'],
+            readonly=True,
+            background_color=get_color_from_hex('#1E293B'),
+            foreground_color=get_color_from_hex('#F1F5F9'),
+            font_size='14sp',
+            padding=[15, 15]
+        )
+        Popup(
+            title=f"{post['platform']} • {post['tone']} • {post['prompt'][:40]}",
+            content=body,
+            size_hint=(0.95, 0.8)
+        ).open()
+    
+    def go_back(self, instance):
+        self.manager.current = 'home'
+
+
+class StatsScreen(Screen):
+    """Latency, error rates and token usage per provider"""
+    
+    COLUMNS = ('Provider', 'Calls', 'p50', 'p95', 'Errors', 'Fallback')
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.storage = App.get_running_app().storage
+        self.tasks = App.get_running_app().tasks
+        
+        layout = BoxLayout(orientation='vertical', padding=20, spacing=15)
+        
+        # Header
+        header_layout = BoxLayout(size_hint_y=None, height=60, spacing=10)
+        header = Label(
+            text='📊 Stats',
+            font_size='28sp',
+            bold=True,
+            color=get_color_from_hex('#A5B4FC')
+        )
+        header_layout.add_widget(header)
+        
+        refresh_btn = Button(
+            text='🔄',
+            size_hint_x=None,
+            width=50,
+            background_color=get_color_from_hex('#6366F1')
+        )
+        refresh_btn.bind(on_press=self.load_stats)
+        header_layout.add_widget(refresh_btn)
+        
+        layout.add_widget(header_layout)
+        
+        # One row per provider; a handful of rows, so a plain grid is enough
+        scroll = ScrollView(size_hint=(1, 1))
+        self.table = GridLayout(cols=len(self.COLUMNS), spacing=5, size_hint_y=None)
+        self.table.bind(minimum_height=self.table.setter('height'))
+        scroll.add_widget(self.table)
+        layout.add_widget(scroll)
+        
+        self.summary_label = Label(
+            font_size='12sp',
+            size_hint_y=None,
+            height=60,
+            color=get_color_from_hex('#94A3B8')
+        )
+        layout.add_widget(self.summary_label)
+        
+        # Back button
+        back_btn = ModernButton(text='← Back')
+        back_btn.background_color = get_color_from_hex('#475569')
+        back_btn.bind(on_press=self.go_back)
+        layout.add_widget(back_btn)
+        
+        self.add_widget(layout)
+    
+    def on_enter(self):
+        self.load_stats()
+    
+    def load_stats(self, *args):
+        """Read the aggregates off the UI thread (reading waits for queued writes)"""
+        self.tasks.submit(lambda cancel: self.storage.get_provider_metrics(), key='stats',
+                          on_result=self.show_stats,
+                          on_error=lambda error: setattr(self.summary_label, 'text', f'❌ {error}'))
+    
+    def show_stats(self, metrics):
+        self.table.clear_widgets()
+        if not metrics:
+            self.summary_label.text = 'No requests recorded yet'
+            return
+        
+        for column in self.COLUMNS:
+            self.table.add_widget(self.cell(column, '#A5B4FC', bold=True))
+        for row in metrics:
+            values = (
+                row['provider'],
+                str(row['requests']),
+                self.format_ms(row['p50_ms']),
+                self.format_ms(row['p95_ms']),
+                f"{row['error_rate']:.0%}",
+                f"{row['fallback_rate']:.0%}",
             )
-            item.add_widget(content)
-            
-            self.history_layout.add_widget(item)
+            for value in values:
+                self.table.add_widget(self.cell(value, '#F1F5F9'))
+        
+        cache_hits = sum(row['cache_hits'] for row in metrics)
+        tokens_in = sum(row['prompt_tokens'] for row in metrics)
+        tokens_out = sum(row['completion_tokens'] for row in metrics)
+        self.summary_label.text = (f'Cache hits: {cache_hits}\n'
+                                   f'Tokens: {tokens_in:,} in • {tokens_out:,} out')
+    
+    @staticmethod
+    def cell(text, color, bold=False):
+        return Label(text=text, font_size='12sp', bold=bold, size_hint_y=None, height=30,
+                     color=get_color_from_hex(color))
+    
+    @staticmethod
+    def format_ms(ms):
+        if ms is None:
+            return '—'
+        return f'{ms / 1000:.1f}s' if ms >= 1000 else f'{ms:.0f}ms'
     
     def go_back(self, instance):
         self.manager.current = 'home'
@@ -501,12 +1126,125 @@ class HistoryScreen(Screen):
 class AIContentGeneratorApp(App):
     """Main application class"""
     
+    # Screens other than home are built the first time they are opened
+    LAZY_SCREENS = {
+        'settings': SettingsScreen,
+        'history': HistoryScreen,
+        'stats': StatsScreen,
+    }
+    
     def build(self):
+        # Shared worker pool; results come back on the Kivy clock
+        self.tasks = TaskRunner(max_workers=4, dispatch=lambda fn: Clock.schedule_once(lambda dt: fn()))
+        # One storage manager for every screen; migrating an old history waits for the first frame
+        self.storage = StorageManager(upgrade=False)
+        self._api_client = None
+        # Offline job queue worker, started once the client is warm
+        self.jobs = None
+        self._api_client_lock = threading.Lock()
+        self.startup_timing = {'imports': IMPORT_TIME}
         sm = ScreenManager()
         sm.add_widget(HomeScreen(name='home'))
-        sm.add_widget(SettingsScreen(name='settings'))
-        sm.add_widget(HistoryScreen(name='history'))
         return sm
+    
+    @property
+    def api_client(self):
+        """Provider client, created on first use to keep the HTTP stack out of startup"""
+        with self._api_client_lock:
+            if self._api_client is None:
+                from api_client import APIClient
+                self._api_client = APIClient(storage=self.storage)
+            return self._api_client
+    
+    def show_screen(self, name):
+        """Switch to a screen, building it on first use"""
+        if not self.root.has_screen(name):
+            self.root.add_widget(self.LAZY_SCREENS[name](name=name))
+        self.root.current = name
+    
+    def on_start(self):
+        Window.bind(on_flip=self._first_frame)
+        self._frame_sampler = None
+        if tracing.is_enabled():
+            self.start_frame_sampling()
+    
+    def start_frame_sampling(self):
+        """Record every frame's duration into the trace while tracing is on"""
+        if self._frame_sampler is None:
+            self._frame_sampler = Clock.schedule_interval(self._sample_frame, 0)
+    
+    def stop_frame_sampling(self):
+        if self._frame_sampler is not None:
+            self._frame_sampler.cancel()
+            self._frame_sampler = None
+    
+    @staticmethod
+    def _sample_frame(dt):
+        tracing.counter('frame', ms=dt * 1000)
+        if dt > 1 / 30:
+            # Missed at least one frame at 60 fps
+            tracing.instant('ui.long_frame', ms=dt * 1000)
+    
+    def _first_frame(self, window):
+        """Report startup timing once the first frame is on screen"""
+        window.unbind(on_flip=self._first_frame)
+        self.startup_timing['first_frame'] = time.perf_counter() - _started
+        print(f"Startup: imports {self.startup_timing['imports'] * 1000:.0f} ms, "
+              f"first frame {self.startup_timing['first_frame'] * 1000:.0f} ms")
+        if self.storage.needs_upgrade:
+            # First launch over the original app's history: migrate it in the background
+            home = self.root.get_screen('home')
+            home.show_upgrading(True)
+            
+            def upgraded(result):
+                home.show_upgrading(False)
+                self.start_background()
+            
+            def failed(error):
+                home.result_text.text = f'❌ Could not upgrade history: {error}'
+            
+            self.tasks.submit(lambda cancel: self.storage.upgrade(), on_result=upgraded, on_error=failed)
+            return
+        self.start_background()
+    
+    def start_background(self):
+        """Background work that needs the database set up"""
+        # Warm up the provider client off the UI thread before the first generate,
+        # then start working through requests queued while offline
+        self.tasks.submit(lambda cancel: self.api_client, on_result=self.start_jobs)
+        # History saved before the near-duplicate index existed (or by a batch) gets indexed
+        self.tasks.submit(lambda cancel: self.storage.index_similarity(cancel=cancel))
+    
+    def start_jobs(self, client):
+        """Start the background worker that drains the offline job queue"""
+        home = self.root.get_screen('home')
+        self.jobs = JobWorker(
+            client, self.storage,
+            on_change=lambda counts: Clock.schedule_once(lambda dt: home.show_job_counts(counts))
+        ).start()
+        self.tasks.submit(lambda cancel: self.jobs.counts(), on_result=home.show_job_counts)
+    
+    def on_pause(self):
+        """Persist queued history writes before Android may kill the app"""
+        self.storage.flush()
+        return True
+    
+    def on_resume(self):
+        """The network may be back after the app was in the background"""
+        if self.jobs is not None:
+            self.jobs.resume()
+    
+    def on_stop(self):
+        """Flush queued writes and close pooled provider connections on shutdown"""
+        if self.jobs is not None:
+            # Unfinished jobs stay queued for the next launch
+            self.jobs.stop(timeout=2)
+        self.tasks.shutdown()
+        if self._api_client is not None:
+            print(f"HTTP connection reuse: {self._api_client.connection_stats()}")
+            self._api_client.close()
+        # Closing the database writes out the history queue first
+        self.storage.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+"""
+Near-duplicate prompt detection
+Prompts are reduced to MinHash signatures of their character shingles,
+using one-permutation hashing (each shingle is hashed once and lands in one
+of NUM_PERM bins) so a signature costs one hash per shingle.
+Locality-sensitive hashing splits each signature into bands; prompts sharing
+any band key are candidates, and the signatures then estimate how similar
+they really are. StorageManager keeps the signatures and band keys of every
+distinct prompt in SQLite.
+"""
+
+import hashlib
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left
+from operator import eq
+
+NUM_PERM = 64
+# 16 bands of 4 rows: prompts around 50% similar or more share a band key
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 3
+
+# Words that change nothing about what is being asked for
+STOPWORDS = frozenset(('a', 'an', 'the', 'please', 'some'))
+
+_EMPTY = (1 << 64) - 1
+# Offset per bin skipped when an empty bin borrows a neighbour's value
+_DENSIFY_STEP = 0x9E3779B97F4A7C15 // NUM_PERM
+
+
+def normalize(text):
+    """Lowercase words without punctuation, accents or filler words"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    words = [word for word in re.split(r'[\W_]+', text) if word and word not in STOPWORDS]
+    return ' '.join(words)
+
+
+def shingles(text):
+    """Overlapping character n-grams of the normalized text"""
+    text = normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def signature(text):
+    """MinHash signature (NUM_PERM ints) of a prompt"""
+    bins = [_EMPTY] * NUM_PERM
+    for shingle in shingles(text):
+        h = _hash64(shingle.encode())
+        index, value = h % NUM_PERM, h // NUM_PERM
+        if value < bins[index]:
+            bins[index] = value
+    # Short prompts leave bins empty; each takes the next filled bin's value
+    # (circularly), shifted by the distance so borrowed values stay distinct
+    filled = [i for i in range(NUM_PERM) if bins[i] != _EMPTY]
+    if filled:
+        for i in range(NUM_PERM):
+            if bins[i] == _EMPTY:
+                source = filled[bisect_left(filled, i) % len(filled)]
+                distance = (source - i) % NUM_PERM
+                bins[i] = (bins[source] + distance * _DENSIFY_STEP) & _EMPTY
+    # The low 32 bits are plenty to tell values apart and halve the stored size
+    return array('I', (value & 0xFFFFFFFF for value in bins))
+
+
+def band_keys(sig):
+    """One LSH key per band, as signed 64-bit ints for SQLite"""
+    keys = []
+    for band in range(BANDS):
+        rows = sig[band * ROWS:(band + 1) * ROWS].tobytes()
+        digest = hashlib.blake2b(bytes((band,)) + rows, digest_size=8).digest()
+        keys.append(int.from_bytes(digest, 'little', signed=True))
+    return keys
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return sum(map(eq, sig_a, sig_b)) / NUM_PERM
+
+
+def pack(sig):
+    return sig.tobytes()
+
+
+def unpack(data):
+    sig = array('I')
+    sig.frombytes(data)
+    return sig
@@ -4,17 +4,669 @@ Handles API keys and content history
 """
 
 import sqlite3
+import csv
+import io
 import json
+import hashlib
+import zlib
 from datetime import datetime
 import os
+import re
+import time
+import threading
+from bisect import bisect_left
+from itertools import groupby
+from contextlib import contextmanager
+
+import similarity
+import tracing
+
+
+# Stored in PRAGMA user_version; bump it whenever the schema setup below changes
+# so existing databases run it once more. The original app left it at 0.
+SCHEMA_VERSION = 1
+
+# Upper bounds (ms) of the request latency histogram buckets; one more bucket holds the rest
+LATENCY_BUCKETS_MS = (25, 50, 75, 100, 150, 200, 300, 400, 500, 750, 1000, 1500,
+                      2000, 3000, 5000, 7500, 10000, 15000, 30000, 60000)
+
+# Raw request_metrics rows kept; the aggregates cover everything ever recorded
+METRICS_KEEP_ROWS = 20000
+
+# History bodies of at least this many bytes are stored zlib-compressed
+COMPRESS_MIN_BYTES = 512
+# Leading characters of every post kept uncompressed for list previews
+PREVIEW_CHARS = 100
+
+# Columns of a history export, in file order; ids are not kept, imports append
+EXPORT_FIELDS = ('prompt', 'content', 'platform', 'tone', 'created_at', 'image_path')
+
+
+def deflate(text):
+    """A post body as stored: zlib-compressed bytes when that pays off, else the text itself"""
+    if text is None:
+        return None
+    data = text.encode('utf-8')
+    if len(data) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data) * 0.9:
+            return packed
+    return text
+
+
+def inflate(body):
+    """The text of a stored post body"""
+    if isinstance(body, bytes):
+        return zlib.decompress(body).decode('utf-8')
+    return body
+
+
+def text_digest(text):
+    """Signed 64-bit hash of a prompt, for the prompts lookup index"""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def histogram_percentile(counts, pct):
+    """Percentile (ms) from LATENCY_BUCKETS_MS counts, interpolated within its bucket"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = pct / 100 * total
+    seen = 0
+    for bucket, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = LATENCY_BUCKETS_MS[bucket - 1] if bucket else 0
+            if bucket == len(LATENCY_BUCKETS_MS):
+                return lower  # Overflow bucket has no upper bound
+            return lower + (LATENCY_BUCKETS_MS[bucket] - lower) * (rank - seen) / count
+        seen += count
+    return LATENCY_BUCKETS_MS[-1]
+
+
+class WriteBehindQueue:
+    """Background writer that group-commits queued statements off the caller's thread"""
+    
+    # Tickets of failed statements remembered for wait(); older ones are forgotten
+    MAX_FAILED_TICKETS = 1000
+    
+    def __init__(self, database, flush_interval=0.5):
+        self.database = database
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._queued = 0  # Statements queued so far; a statement's ticket is its number
+        self._written = 0  # Statements committed (or given up on) so far
+        self._failed = set()  # Tickets given up on
+        self._flush_now = False
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def put(self, sql, params):
+        """Queue a write; returns immediately with a ticket for wait()"""
+        with self._cond:
+            if self._closing:
+                raise RuntimeError("write queue is closed")
+            self._queued += 1
+            self._pending.append((self._queued, sql, params))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return self._queued
+    
+    def wait(self, ticket, timeout=None):
+        """
+        Block until the statement put() returned ticket for is written, without
+        hurrying the group commit; True if it was committed, False if it was
+        given up on, None on timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._written >= ticket, timeout):
+                return None
+            return ticket not in self._failed
+    
+    def flush(self, timeout=None):
+        """Block until everything queued so far is committed (or given up on); False on timeout"""
+        with self._cond:
+            target = self._queued
+            self._flush_now = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+    
+    def close(self):
+        """Write out what is pending and stop the writer thread"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closing)
+                if not self._pending:
+                    return
+                if not (self._flush_now or self._closing):
+                    # Let more rows pile up so they share one commit
+                    self._cond.wait_for(lambda: self._flush_now or self._closing, self.flush_interval)
+                batch, self._pending = self._pending, []
+                self._flush_now = False
+                written = self._queued
+            try:
+                failed = self._write(batch)
+            except Exception as e:
+                print(f"background write of {len(batch)} rows failed: {e}")
+                failed = [ticket for ticket, _, _ in batch]
+            with self._cond:
+                self._written = written
+                self._failed.update(failed)
+                while len(self._failed) > self.MAX_FAILED_TICKETS:
+                    self._failed.remove(min(self._failed))
+                self._cond.notify_all()
+    
+    def _write(self, batch):
+        """Commit a batch; returns the tickets of the statements that could not be written"""
+        # Consecutive statements with the same SQL go out as one executemany
+        groups = [(sql, [(ticket, params) for ticket, _, params in group])
+                  for sql, group in groupby(batch, key=lambda item: item[1])]
+        try:
+            with tracing.span('db.write_batch', statements=len(batch)):
+                self._commit(groups)
+            return []
+        except Exception as e:
+            print(f"background write of {len(batch)} rows failed, retrying them apart: {e}")
+        
+        # One bad statement (say a telemetry row) must not take history rows down with it
+        failed = []
+        for sql, rows in groups:
+            try:
+                self._commit([(sql, rows)])
+                continue
+            except Exception:
+                pass
+            for row in rows:
+                try:
+                    self._commit([(sql, [row])])
+                except Exception as e:
+                    failed.append(row[0])
+                    print(f"background write dropped ({e}): {' '.join(sql.split())[:60]}…")
+        return failed
+    
+    def _commit(self, groups):
+        with self.database.transaction() as cursor:
+            for sql, rows in groups:
+                cursor.executemany(sql, [params for _, params in rows])
+
+
+class Database:
+    """One long-lived SQLite connection per database file, shared by all threads"""
+    
+    def __init__(self, db_path, upgrade=True):
+        self.db_path = db_path
+        # sqlite3 serializes access itself, the lock keeps transactions from interleaving
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._configure()
+        self.has_fts = False
+        self.needs_upgrade = self.query('PRAGMA user_version')[0][0] < SCHEMA_VERSION
+        if not self.needs_upgrade:
+            # Schema is current, skip the DDL on every launch
+            self.has_fts = bool(self.query(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'content_history_fts'"
+            ))
+            if self.has_fts and self.search_index_deferred():
+                # A bulk import stopped before catching the index up (the app was killed)
+                self.resume_search_index()
+        elif upgrade:
+            self.upgrade()
+        self.writer = WriteBehindQueue(self)
+        # API keys are read on every generation but change only in Settings
+        self.keys_version = 0
+        # Counts telemetry rows queued, to prune request_metrics now and then
+        self.metrics_queued = 0
+        self._keys_cache = None
+        # Held for a whole bulk import, so only one defers the search index at a time
+        self.bulk_lock = threading.Lock()
+    
+    def upgrade(self):
+        """
+        Set up the schema, migrating history the original app wrote
+        Takes seconds on a large history, so the app runs it off the UI thread
+        and uses nothing else in the database until it is done.
+        """
+        if not self.needs_upgrade:
+            return
+        with tracing.span('db.upgrade'):
+            migrated = self._init_database()
+            self.has_fts = self._init_search_index()
+            with self.transaction() as cursor:
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            if migrated:
+                # Hand the space freed by the old history table back to the filesystem
+                with self.lock:
+                    self.conn.execute('VACUUM')
+        self.needs_upgrade = False
+    
+    def _configure(self):
+        """Tune the connection for a small, write-light mobile database"""
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # NORMAL is durable across app crashes in WAL mode, only power loss can drop the last commit
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-8000')  # 8 MB page cache
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        # Used by the content_history view and its triggers
+        self.conn.create_function('deflate', 1, deflate, deterministic=True)
+        self.conn.create_function('inflate', 1, inflate, deterministic=True)
+        self.conn.create_function('text_digest', 1, text_digest, deterministic=True)
+    
+    def _init_database(self):
+        """Initialize database tables; returns True if history was moved to the compact layout"""
+        migrated = False
+        with self.transaction() as cursor:
+            # API keys table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_keys (
+                    provider TEXT PRIMARY KEY,
+                    api_key TEXT NOT NULL
+                )
+            ''')
+            # Several keys per provider, used in turn; api_keys held one each
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS api_key_pool (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    provider TEXT NOT NULL,
+                    api_key TEXT NOT NULL,
+                    position INTEGER DEFAULT 0,
+                    requests INTEGER DEFAULT 0,
+                    rate_limited INTEGER DEFAULT 0,
+                    last_used REAL,
+                    UNIQUE (provider, api_key)
+                )
+            ''')
+            # Move the one key per provider the original app saved; emptying
+            # api_keys keeps a later schema upgrade from bringing deleted keys back
+            cursor.execute('''
+                INSERT OR IGNORE INTO api_key_pool (provider, api_key)
+                SELECT provider, api_key FROM api_keys WHERE api_key != ''
+            ''')
+            cursor.execute('DELETE FROM api_keys')
+            
+            # Content history: each distinct prompt is stored once, post metadata
+            # and a short preview in posts, and the (possibly compressed) body in
+            # post_bodies, so listing history never reads or inflates bodies
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS prompts (
+                    id INTEGER PRIMARY KEY,
+                    digest INTEGER NOT NULL,
+                    text TEXT NOT NULL
+                )
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_prompts_digest ON prompts (digest)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prompt_id INTEGER NOT NULL,
+                    platform TEXT,
+                    tone TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    image_path TEXT,
+                    preview TEXT
+                )
+            ''')
+            # Newest-first listing walks this index instead of sorting the table
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_posts_created
+                ON posts (created_at DESC, id DESC)
+            ''')
+            # Posts of a prompt, for near-duplicate lookups
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_posts_prompt ON posts (prompt_id)')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS post_bodies (
+                    post_id INTEGER PRIMARY KEY,
+                    body
+                )
+            ''')
+            
+            if self._history_is_table(cursor):
+                self._migrate_history(cursor)
+                migrated = True
+            # The full-text index and older code read history through this view
+            cursor.execute('''
+                CREATE VIEW IF NOT EXISTS content_history AS
+                SELECT p.id AS id, pr.text AS prompt, inflate(b.body) AS content, p.platform AS platform,
+                       p.tone AS tone, p.created_at AS created_at, p.image_path AS image_path
+                FROM posts p
+                JOIN prompts pr ON pr.id = p.prompt_id
+                LEFT JOIN post_bodies b ON b.post_id = p.id
+            ''')
+            self._create_history_triggers(cursor, fts=False)
+            
+            # Near-duplicate index over the distinct prompts (see similarity.py),
+            # filled in by StorageManager.index_similarity
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS prompt_signatures (
+                    prompt_id INTEGER PRIMARY KEY,
+                    signature BLOB NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS prompt_lsh (
+                    band_key INTEGER NOT NULL,
+                    prompt_id INTEGER NOT NULL,
+                    PRIMARY KEY (band_key, prompt_id)
+                ) WITHOUT ROWID
+            ''')
+            
+            # Generation requests waiting for the network (see job_queue.JobWorker)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS job_queue (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    prompt TEXT NOT NULL,
+                    platform TEXT,
+                    tone TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_job_queue_due
+                ON job_queue (status, next_attempt_at)
+            ''')
+            
+            # Provider response cache (LRU by last_access, per-entry expiry)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    model TEXT,
+                    content TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_response_cache_last_access
+                ON response_cache (last_access)
+            ''')
+            
+            # Rolling provider health, so circuit breakers survive restarts
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS provider_stats (
+                    provider TEXT PRIMARY KEY,
+                    latencies TEXT NOT NULL,
+                    outcomes TEXT NOT NULL,
+                    consecutive_failures INTEGER DEFAULT 0,
+                    state TEXT NOT NULL,
+                    opened_at REAL,
+                    cooldown REAL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            
+            # One row per provider call (telemetry), pruned to the most recent rows
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS request_metrics (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    provider TEXT NOT NULL,
+                    model TEXT,
+                    kind TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    latency REAL NOT NULL,
+                    latency_bucket INTEGER NOT NULL,
+                    ttfb REAL,
+                    prompt_chars INTEGER,
+                    response_chars INTEGER,
+                    prompt_tokens INTEGER,
+                    completion_tokens INTEGER,
+                    fallback INTEGER DEFAULT 0
+                )
+            ''')
+            # Running totals per provider, so the Stats screen never scans request_metrics
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS provider_metrics (
+                    provider TEXT PRIMARY KEY,
+                    requests INTEGER DEFAULT 0,
+                    ok INTEGER DEFAULT 0,
+                    errors INTEGER DEFAULT 0,
+                    cancelled INTEGER DEFAULT 0,
+                    cache_hits INTEGER DEFAULT 0,
+                    fallbacks INTEGER DEFAULT 0,
+                    latency_sum REAL DEFAULT 0,
+                    ttfb_sum REAL DEFAULT 0,
+                    ttfb_count INTEGER DEFAULT 0,
+                    prompt_tokens INTEGER DEFAULT 0,
+                    completion_tokens INTEGER DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS latency_histogram (
+                    provider TEXT NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    count INTEGER DEFAULT 0,
+                    PRIMARY KEY (provider, bucket)
+                )
+            ''')
+            # Aggregates are updated in the same transaction as the insert
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS request_metrics_aggregate
+                AFTER INSERT ON request_metrics BEGIN
+                    INSERT OR IGNORE INTO provider_metrics (provider) VALUES (new.provider);
+                    UPDATE provider_metrics SET
+                        requests = requests + (new.outcome != 'cache_hit'),
+                        ok = ok + (new.outcome = 'ok'),
+                        errors = errors + (new.outcome = 'error'),
+                        cancelled = cancelled + (new.outcome = 'cancelled'),
+                        cache_hits = cache_hits + (new.outcome = 'cache_hit'),
+                        fallbacks = fallbacks + new.fallback,
+                        latency_sum = latency_sum + (CASE WHEN new.outcome = 'ok' THEN new.latency ELSE 0 END),
+                        ttfb_sum = ttfb_sum + (CASE WHEN new.outcome = 'ok' THEN coalesce(new.ttfb, 0) ELSE 0 END),
+                        ttfb_count = ttfb_count + (new.outcome = 'ok' AND new.ttfb IS NOT NULL),
+                        prompt_tokens = prompt_tokens + coalesce(new.prompt_tokens, 0),
+                        completion_tokens = completion_tokens + coalesce(new.completion_tokens, 0)
+                    WHERE provider = new.provider;
+                    INSERT OR IGNORE INTO latency_histogram (provider, bucket)
+                    SELECT new.provider, new.latency_bucket WHERE new.outcome = 'ok';
+                    UPDATE latency_histogram SET count = count + 1
+                    WHERE new.outcome = 'ok' AND provider = new.provider AND bucket = new.latency_bucket;
+                END
+            ''')
+        return migrated
+    
+    @staticmethod
+    def _history_is_table(cursor):
+        """True for databases that still keep history in a plain content_history table"""
+        row = cursor.execute("SELECT type FROM sqlite_master WHERE name = 'content_history'").fetchone()
+        return row is not None and row[0] == 'table'
+    
+    @staticmethod
+    def _migrate_history(cursor):
+        """Move a plain content_history table into prompts / posts / post_bodies, keeping row ids"""
+        cursor.execute('''
+            INSERT INTO prompts (digest, text)
+            SELECT text_digest(prompt), prompt FROM content_history GROUP BY prompt
+        ''')
+        cursor.execute('''
+            INSERT INTO posts (id, prompt_id, platform, tone, created_at, preview)
+            SELECT h.id, pr.id, h.platform, h.tone, h.created_at, substr(h.content, 1, ?)
+            FROM content_history h
+            JOIN prompts pr ON pr.digest = text_digest(h.prompt) AND pr.text = h.prompt
+        ''', (PREVIEW_CHARS + 1,))
+        cursor.execute('INSERT INTO post_bodies (post_id, body) SELECT id, deflate(content) FROM content_history')
+        cursor.execute('DROP TABLE content_history')
+    
+    @staticmethod
+    def _create_history_triggers(cursor, fts):
+        """Make content_history writable: inserts intern the prompt and compress the body"""
+        fts_insert = fts_delete = ''
+        if fts:
+            fts_insert = '''
+                INSERT INTO content_history_fts (rowid, prompt, content)
+                VALUES (last_insert_rowid(), new.prompt, new.content);
+            '''
+            fts_delete = '''
+                INSERT INTO content_history_fts (content_history_fts, rowid, prompt, content)
+                VALUES ('delete', old.id, old.prompt, old.content);
+            '''
+        cursor.execute('DROP TRIGGER IF EXISTS content_history_insert')
+        cursor.execute(f'''
+            CREATE TRIGGER content_history_insert
+            INSTEAD OF INSERT ON content_history BEGIN
+                INSERT INTO prompts (digest, text)
+                SELECT text_digest(new.prompt), new.prompt
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM prompts WHERE digest = text_digest(new.prompt) AND text = new.prompt
+                );
+                INSERT INTO posts (id, prompt_id, platform, tone, created_at, image_path, preview)
+                VALUES (
+                    new.id,
+                    (SELECT id FROM prompts WHERE digest = text_digest(new.prompt) AND text = new.prompt),
+                    new.platform, new.tone, coalesce(new.created_at, CURRENT_TIMESTAMP), new.image_path,
+                    substr(new.content, 1, {PREVIEW_CHARS + 1})
+                );
+                -- post_bodies.post_id is its rowid, so last_insert_rowid() stays the post id
+                INSERT INTO post_bodies (post_id, body) VALUES (last_insert_rowid(), deflate(new.content));
+                {fts_insert}
+            END
+        ''')
+        cursor.execute('DROP TRIGGER IF EXISTS content_history_delete')
+        cursor.execute(f'''
+            CREATE TRIGGER content_history_delete
+            INSTEAD OF DELETE ON content_history BEGIN
+                {fts_delete}
+                DELETE FROM post_bodies WHERE post_id = old.id;
+                DELETE FROM posts WHERE id = old.id;
+            END
+        ''')
+    
+    def _init_search_index(self):
+        """Full-text index over history prompts and content; False if FTS5 is unavailable"""
+        exists = self.query(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'content_history_fts'"
+        )
+        try:
+            with self.transaction() as cursor:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS content_history_fts USING fts5(
+                        prompt, content,
+                        content='content_history', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                ''')
+                # Keep the index in step with content_history
+                self._create_history_triggers(cursor, fts=True)
+                if not exists:
+                    # Index the history the original app wrote
+                    cursor.execute("INSERT INTO content_history_fts (content_history_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            print(f"full-text search unavailable, falling back to LIKE: {e}")
+            return False
+        return True
+    
+    def search_index_deferred(self):
+        """True while history inserts skip the full-text index (during a bulk import)"""
+        rows = self.query(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'content_history_insert'"
+        )
+        return bool(rows) and 'content_history_fts' not in rows[0][0]
+    
+    def defer_search_index(self):
+        """Stop indexing history inserts one by one; resume_search_index() catches up"""
+        if self.has_fts:
+            with self.transaction() as cursor:
+                self._create_history_triggers(cursor, fts=False)
+    
+    def resume_search_index(self, chunk=20000, progress=None):
+        """
+        Index the history rows inserted since defer_search_index() and go back
+        to indexing every insert
+        Rows are only ever appended (ids grow), so everything past the highest
+        indexed id is what is missing. Runs chunk rows per transaction so other
+        readers and writers get in between; progress(fraction) follows along.
+        """
+        if not self.has_fts:
+            return
+        indexed_sql = 'SELECT coalesce(max(id), 0) FROM content_history_fts_docsize'
+        first = self.query(indexed_sql)[0][0]
+        last = self.query('SELECT coalesce(max(id), 0) FROM posts')[0][0]
+        while True:
+            with self.transaction() as cursor:
+                cursor.execute(f'''
+                    INSERT INTO content_history_fts (rowid, prompt, content)
+                    SELECT id, prompt, content FROM content_history
+                    WHERE id > ({indexed_sql})
+                    ORDER BY id
+                    LIMIT ?
+                ''', (chunk,))
+                if cursor.rowcount < chunk:
+                    # Caught up; switching back in the same transaction leaves no gap
+                    self._create_history_triggers(cursor, fts=True)
+                    break
+                done = cursor.execute(indexed_sql).fetchone()[0]
+            if progress is not None and last > first:
+                progress(min((done - first) / (last - first), 1.0))
+    
+    @contextmanager
+    def transaction(self):
+        """Cursor inside an exclusive transaction, committed on success"""
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+                with tracing.span('db.commit'):
+                    self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+            finally:
+                cursor.close()
+    
+    def query(self, sql, params=(), row_factory=None):
+        """Run a read query and return all rows"""
+        with self.lock, tracing.span('db.query', sql=sql):
+            cursor = self.conn.cursor()
+            try:
+                cursor.row_factory = row_factory
+                cursor.execute(sql, params)
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+    
+    def close(self):
+        self.writer.close()
+        with self.lock:
+            self.conn.close()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_path, upgrade=True):
+    """Shared Database for a path; the schema is set up by the first caller only"""
+    with _databases_lock:
+        database = _databases.get(db_path)
+        if database is None:
+            database = _databases[db_path] = Database(db_path, upgrade)
+        return database
 
 
 class StorageManager:
     """Manages local SQLite database for app data"""
     
-    def __init__(self):
-        self.db_path = self._get_db_path()
-        self._init_database()
+    def __init__(self, db_path=None, upgrade=True):
+        """With upgrade=False an outdated schema is left for upgrade() to set up"""
+        self.db_path = db_path or self._get_db_path()
+        self.db = get_database(self.db_path, upgrade)
     
     def _get_db_path(self):
         """Get database path (app data directory on Android)"""
@@ -28,94 +680,633 @@ class StorageManager:
         
         return os.path.join(db_dir, 'ai_content_generator.db')
     
-    def _init_database(self):
-        """Initialize database tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    @property
+    def needs_upgrade(self):
+        """True until the schema has been set up (see upgrade())"""
+        return self.db.needs_upgrade
+    
+    def upgrade(self):
+        """Set up an outdated schema; slow the first time the original app's history is opened"""
+        self.db.upgrade()
+    
+    def close(self):
+        """Close the shared connection (every StorageManager on this path)"""
+        with _databases_lock:
+            if _databases.get(self.db_path) is self.db:
+                del _databases[self.db_path]
+        self.db.close()
+    
+    @property
+    def keys_version(self):
+        """Change counter bumped by every save_api_keys"""
+        return self.db.keys_version
+    
+    def save_api_keys(self, keys):
+        """
+        Save API keys to database
+        Each value is one key or a list of keys for that provider, in the order
+        they are tried. A non-empty value replaces the provider's pool; usage
+        counters of keys that stay are kept.
+        """
+        with self.db.transaction() as cursor:
+            for provider, pool in keys.items():
+                pool = [pool] if isinstance(pool, str) else list(pool or ())
+                pool = list(dict.fromkeys(key.strip() for key in pool if key and key.strip()))
+                if not pool:  # Only save non-empty keys
+                    continue
+                placeholders = ', '.join('?' * len(pool))
+                cursor.execute(f'''
+                    DELETE FROM api_key_pool WHERE provider = ? AND api_key NOT IN ({placeholders})
+                ''', (provider, *pool))
+                for position, key in enumerate(pool):
+                    cursor.execute('''
+                        INSERT OR IGNORE INTO api_key_pool (provider, api_key) VALUES (?, ?)
+                    ''', (provider, key))
+                    cursor.execute('''
+                        UPDATE api_key_pool SET position = ? WHERE provider = ? AND api_key = ?
+                    ''', (position, provider, key))
+            # Invalidate while still holding the lock so no reader caches stale keys
+            self.db._keys_cache = None
+            self.db.keys_version += 1
+    
+    def get_api_key_pools(self):
+        """Every provider's keys in the order they are tried (served from memory after the first read)"""
+        with self.db.lock:
+            if self.db._keys_cache is None:
+                rows = self.db.query('''
+                    SELECT provider, api_key FROM api_key_pool ORDER BY provider, position, id
+                ''')
+                self.db._keys_cache = {
+                    provider: [key for _, key in group]
+                    for provider, group in groupby(rows, key=lambda row: row[0])
+                }
+            return {provider: list(pool) for provider, pool in self.db._keys_cache.items()}
+    
+    def get_api_keys(self):
+        """The first key of every provider's pool"""
+        return {provider: pool[0] for provider, pool in self.get_api_key_pools().items()}
+    
+    def record_key_usage(self, provider, api_key, rate_limited=False):
+        """Queue a request count (and a 429 if it was refused) against one pooled key"""
+        self.db.writer.put('''
+            UPDATE api_key_pool
+            SET requests = requests + 1, rate_limited = rate_limited + ?, last_used = ?
+            WHERE provider = ? AND api_key = ?
+        ''', (int(rate_limited), time.time(), provider, api_key))
+    
+    def get_key_usage(self):
+        """Requests and 429 responses per pooled key"""
+        self.flush()
+        rows = self.db.query('''
+            SELECT provider, api_key, requests, rate_limited, last_used
+            FROM api_key_pool ORDER BY provider, position, id
+        ''', row_factory=sqlite3.Row)
+        return [dict(row) for row in rows]
+    
+    def save_post(self, prompt, content, platform, tone, image_path=None):
+        """Queue generated content for the background history writer; returns a ticket for wait_saved()"""
+        # Stamp now rather than at flush time so ordering matches generation order
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        return self.db.writer.put('''
+            INSERT INTO content_history (prompt, content, platform, tone, created_at, image_path)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (prompt, content, platform, tone, created_at, image_path))
+    
+    def save_posts(self, posts):
+        """Save many (prompt, content, platform, tone) rows in one transaction"""
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self.db.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO content_history (prompt, content, platform, tone, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(*post, created_at) for post in posts])
+    
+    def wait_saved(self, ticket, timeout=None):
+        """
+        Wait for the post save_post() returned ticket for to reach the database
+        True once committed, False if it could not be written, None on timeout.
+        """
+        return self.db.writer.wait(ticket, timeout)
+    
+    def flush(self, timeout=None):
+        """Wait until every queued write is on disk"""
+        return self.db.writer.flush(timeout)
+    
+    def get_history(self, limit=50):
+        """Retrieve content history"""
+        # Read-your-writes: rows still queued must show up
+        self.flush()
+        rows = self.db.query('''
+            SELECT * FROM content_history
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (limit,), row_factory=sqlite3.Row)
         
-        # API keys table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS api_keys (
-                provider TEXT PRIMARY KEY,
-                api_key TEXT NOT NULL
-            )
-        ''')
+        return [dict(row) for row in rows]
+    
+    def get_history_page(self, before=None, limit=30, preview_chars=100):
+        """
+        One page of history, newest first, with only preview columns
+        before is the cursor returned by the previous page. Returns
+        (rows, next_cursor); next_cursor is None after the last page.
+        """
+        self.flush()
         
-        # Content history table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS content_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                prompt TEXT NOT NULL,
-                content TEXT NOT NULL,
-                platform TEXT,
-                tone TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        where, params = '', ()
+        if before is not None:
+            # Keyset pagination: seek past the last row instead of using OFFSET
+            # (written without row values so the index range seek works on older SQLite too)
+            where = 'WHERE created_at <= ? AND (created_at < ? OR id < ?)'
+            params = (before[0], before[0], before[1])
+        
+        # The stored preview covers short previews; only longer ones inflate the body
+        text = 'preview' if preview_chars <= PREVIEW_CHARS else \
+            '(SELECT inflate(body) FROM post_bodies WHERE post_id = posts.id)'
+        # One extra character tells whether the preview was cut off
+        rows = self.db.query(f'''
+            SELECT id, platform, tone, created_at, image_path, substr({text}, 1, ?) AS preview
+            FROM posts
+            {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ''', (preview_chars + 1, *params, limit), row_factory=sqlite3.Row)
+        
+        page = []
+        for row in rows:
+            row = dict(row)
+            row['truncated'] = len(row['preview']) > preview_chars
+            row['preview'] = row['preview'][:preview_chars]
+            page.append(row)
         
-        conn.commit()
-        conn.close()
+        next_cursor = (page[-1]['created_at'], page[-1]['id']) if len(page) == limit else None
+        return page, next_cursor
     
-    def save_api_keys(self, keys):
-        """Save API keys to database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def search_history(self, query, platform=None, tone=None, since=None, until=None,
+                       limit=50, highlight=('[', ']')):
+        """
+        Ranked full-text search over history prompts and content
+        Every word of the query must match, the last one as a prefix so results
+        update while typing. since/until are 'YYYY-MM-DD' bounds on created_at.
+        Each row gets a 'snippet' of matching content wrapped in the highlight markers;
+        the full content is left to get_post.
+        """
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
         
-        for provider, key in keys.items():
-            if key:  # Only save non-empty keys
-                cursor.execute('''
-                    INSERT OR REPLACE INTO api_keys (provider, api_key)
-                    VALUES (?, ?)
-                ''', (provider, key))
+        self.flush()
         
-        conn.commit()
-        conn.close()
+        filters, params = [], []
+        for column, value in (('platform', platform), ('tone', tone)):
+            if value:
+                filters.append(f'h.{column} = ?')
+                params.append(value)
+        if since:
+            filters.append('h.created_at >= ?')
+            params.append(since)
+        if until:
+            # Inclusive of the whole end day
+            filters.append('h.created_at < date(?, \'+1 day\')')
+            params.append(until)
+        
+        if self.db.has_fts:
+            # Quote every word so FTS operators in user input are taken literally
+            match = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+            where = ' AND '.join(['content_history_fts MATCH ?'] + filters)
+            rows = self.db.query(f'''
+                SELECT h.id, h.prompt, h.platform, h.tone, h.created_at,
+                       snippet(content_history_fts, -1, ?, ?, '…', 16) AS snippet
+                FROM content_history_fts
+                JOIN content_history h ON h.id = content_history_fts.rowid
+                WHERE {where}
+                ORDER BY bm25(content_history_fts)
+                LIMIT ?
+            ''', (*highlight, match.strip(), *params, limit), row_factory=sqlite3.Row)
+            return [dict(row) for row in rows]
+        
+        # No FTS5 in this SQLite build: unranked substring scan
+        for word in words:
+            filters.append('(h.prompt LIKE ? OR h.content LIKE ?)')
+            params += [f'%{word}%', f'%{word}%']
+        rows = self.db.query(f'''
+            SELECT h.id, h.prompt, h.platform, h.tone, h.created_at,
+                   substr(h.content, 1, 100) AS snippet
+            FROM content_history h
+            WHERE {' AND '.join(filters)}
+            ORDER BY h.created_at DESC, h.id DESC
+            LIMIT ?
+        ''', (*params, limit), row_factory=sqlite3.Row)
+        return [dict(row) for row in rows]
     
-    def get_api_keys(self):
-        """Retrieve all API keys"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def get_post(self, post_id):
+        """One full history post (the only read that inflates its body), or None"""
+        self.flush()
+        rows = self.db.query('SELECT * FROM content_history WHERE id = ?', (post_id,), row_factory=sqlite3.Row)
+        return dict(rows[0]) if rows else None
+    
+    def clear_history(self):
+        """Clear all content history"""
+        self.flush()
+        with self.db.transaction() as cursor:
+            # Straight to the tables: deleting through the view would inflate every body
+            if self.db.has_fts:
+                cursor.execute("INSERT INTO content_history_fts (content_history_fts) VALUES ('delete-all')")
+            cursor.execute('DELETE FROM post_bodies')
+            cursor.execute('DELETE FROM posts')
+            cursor.execute('DELETE FROM prompts')
+            cursor.execute('DELETE FROM prompt_signatures')
+            cursor.execute('DELETE FROM prompt_lsh')
+    
+    @staticmethod
+    def history_file_format(path, fmt=None):
+        """'jsonl' or 'csv', from fmt or else the file extension"""
+        fmt = (fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')).lower()
+        if fmt not in ('jsonl', 'csv'):
+            raise Exception(f"Unknown history file format: {fmt}")
+        return fmt
+    
+    def export_history(self, path, fmt=None, chunk=1000, progress=None, cancel=None):
+        """
+        Write all history, oldest first, to a JSON Lines or CSV file; returns the row count
+        Rows are streamed from a cursor chunk at a time, so memory stays flat
+        however long the history is. The rows come from a separate read-only
+        connection, which reads one consistent snapshot without holding up the
+        app's own reads and writes. The file only appears once complete;
+        progress(fraction) is called after every chunk.
+        """
+        fmt = self.history_file_format(path, fmt)
+        self.flush()
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.create_function('inflate', 1, inflate, deterministic=True)
+        partial = path + '.part'
+        written = 0
+        try:
+            conn.execute('PRAGMA query_only = ON')
+            total = conn.execute('SELECT count(*) FROM posts').fetchone()[0]
+            cursor = conn.execute(f'SELECT {", ".join(EXPORT_FIELDS)} FROM content_history ORDER BY id')
+            with tracing.span('db.export_history', format=fmt), \
+                    open(partial, 'w', encoding='utf-8', newline='') as f:
+                if fmt == 'csv':
+                    writer = csv.writer(f)
+                    writer.writerow(EXPORT_FIELDS)
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        break
+                    rows = cursor.fetchmany(chunk)
+                    if not rows:
+                        break
+                    if fmt == 'csv':
+                        writer.writerows(rows)
+                    else:
+                        f.write(''.join(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + '\n'
+                                        for row in rows))
+                    written += len(rows)
+                    if progress is not None and total:
+                        progress(min(written / total, 1.0))
+            if cancel is not None and cancel.is_set():
+                os.remove(partial)
+            else:
+                os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        finally:
+            conn.close()
+        return written
+    
+    @staticmethod
+    def read_history_file(path, fmt=None):
+        """
+        Yield (row, bytes_read) for every post in a history export, as a stream
+        row holds the EXPORT_FIELDS values; blank fields after content become None.
+        """
+        fmt = StorageManager.history_file_format(path, fmt)
+        with open(path, 'rb') as raw:
+            if fmt == 'csv':
+                reader = csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+                records = ((reader.line_num, record) for record in reader)
+            else:
+                records = ((number, line) for number, line in enumerate(raw, 1) if line.strip())
+            for line, record in records:
+                if fmt == 'jsonl':
+                    try:
+                        record = json.loads(record)
+                    except ValueError as e:
+                        raise Exception(f"{path} line {line}: not valid JSON ({e})")
+                if not isinstance(record, dict) or not isinstance(record.get('prompt'), str) \
+                        or not isinstance(record.get('content'), str):
+                    raise Exception(f"{path} line {line}: a post needs prompt and content text")
+                optional = (record.get(field) or None for field in EXPORT_FIELDS[2:])
+                yield (record['prompt'], record['content'], *optional), raw.tell()
+    
+    def import_history(self, path, fmt=None, chunk=5000, progress=None, cancel=None):
+        """
+        Append the posts of an export_history file to history; returns how many
+        The file is parsed as a stream and written chunk posts per executemany
+        transaction. The full-text index is deferred and caught up once at the
+        end, which is several times faster than indexing row by row. Cancelling
+        keeps the chunks already written. progress(stage, fraction) reports the
+        'import' and then the 'index' stage.
+        """
+        size = os.path.getsize(path) or 1
+        imported = 0
         
-        cursor.execute('SELECT provider, api_key FROM api_keys')
-        rows = cursor.fetchall()
-        conn.close()
+        def write(batch):
+            with self.db.transaction() as cursor:
+                cursor.executemany('''
+                    INSERT INTO content_history (prompt, content, platform, tone, created_at, image_path)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', batch)
         
-        return {provider: key for provider, key in rows}
+        with self.db.bulk_lock, tracing.span('db.import_history') as span:
+            self.flush()
+            self.db.defer_search_index()
+            try:
+                batch = []
+                for row, offset in self.read_history_file(path, fmt):
+                    batch.append(row)
+                    if len(batch) < chunk:
+                        continue
+                    write(batch)
+                    imported += len(batch)
+                    batch = []
+                    if progress is not None:
+                        progress('import', min(offset / size, 1.0))
+                    if cancel is not None and cancel.is_set():
+                        break
+                else:
+                    if batch:
+                        write(batch)
+                        imported += len(batch)
+            finally:
+                # Also after a bad line: the posts before it are kept and get indexed
+                self.db.resume_search_index(
+                    progress=None if progress is None else lambda fraction: progress('index', fraction))
+            span.set(rows=imported)
+        return imported
+    
+    def index_similarity(self, limit=None, chunk=1000, cancel=None):
+        """
+        Add prompts saved since the last call to the near-duplicate index
+        At most limit prompts (all when None); returns how many were indexed.
+        Setting the cancel token stops it between chunks.
+        """
+        indexed = 0
+        while (limit is None or indexed < limit) and not (cancel is not None and cancel.is_set()):
+            size = chunk if limit is None else min(chunk, limit - indexed)
+            rows = self.db.query('''
+                SELECT id, text FROM prompts
+                WHERE id > (SELECT coalesce(max(prompt_id), 0) FROM prompt_signatures)
+                ORDER BY id
+                LIMIT ?
+            ''', (size,))
+            if not rows:
+                break
+            signatures, bands = [], []
+            for prompt_id, text in rows:
+                sig = similarity.signature(text)
+                signatures.append((prompt_id, similarity.pack(sig)))
+                bands.extend((key, prompt_id) for key in similarity.band_keys(sig))
+            with self.db.transaction() as cursor:
+                # Another thread may have indexed the same prompts meanwhile
+                cursor.executemany('INSERT OR IGNORE INTO prompt_signatures VALUES (?, ?)', signatures)
+                cursor.executemany('INSERT OR IGNORE INTO prompt_lsh VALUES (?, ?)', bands)
+            indexed += len(rows)
+        return indexed
+    
+    def find_similar(self, prompt, platform, tone, threshold=0.8, limit=3):
+        """
+        Earlier posts for the same platform and tone whose prompt is at least
+        threshold similar to prompt, most similar (then newest) first
+        Each row carries its estimated 'similarity'.
+        """
+        with tracing.span('db.find_similar'):
+            self.flush()
+            # Catch up on the latest prompts; a large backlog is left to index_similarity()
+            self.index_similarity(limit=100)
+            sig = similarity.signature(prompt)
+            keys = similarity.band_keys(sig)
+            candidates = self.db.query(f'''
+                SELECT prompt_id, signature FROM prompt_signatures
+                WHERE prompt_id IN (SELECT prompt_id FROM prompt_lsh WHERE band_key IN ({', '.join('?' * len(keys))}))
+            ''', keys)
+            scores = {}
+            for prompt_id, blob in candidates:
+                score = similarity.similarity(sig, similarity.unpack(blob))
+                if score >= threshold:
+                    scores[prompt_id] = score
+            if not scores:
+                return []
+            
+            posts = self.db.query(f'''
+                SELECT id, prompt_id FROM posts
+                WHERE prompt_id IN ({', '.join('?' * len(scores))}) AND platform = ? AND tone = ?
+            ''', (*scores, platform, tone))
+            best = sorted(posts, key=lambda post: (scores[post[1]], post[0]), reverse=True)[:limit]
+            if not best:
+                return []
+            rows = self.db.query(f'''
+                SELECT * FROM content_history WHERE id IN ({', '.join('?' * len(best))})
+            ''', [post_id for post_id, _ in best], row_factory=sqlite3.Row)
+            by_id = {row['id']: dict(row) for row in rows}
+            return [{**by_id[post_id], 'similarity': scores[prompt_id]} for post_id, prompt_id in best]
+    
+    def enqueue_job(self, prompt, platform, tone):
+        """Queue a generation request to run when the network allows; returns its id"""
+        # Written straight away, not through the writer: a queued job must survive a crash
+        now = time.time()
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO job_queue (prompt, platform, tone, next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (prompt, platform, tone, now, now))
+            return cursor.lastrowid
     
-    def save_post(self, prompt, content, platform, tone):
-        """Save generated content to history"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def claim_jobs(self, limit):
+        """Mark up to limit due jobs as running and return them, oldest first"""
+        with self.db.transaction() as cursor:
+            cursor.row_factory = sqlite3.Row
+            jobs = [dict(row) for row in cursor.execute('''
+                SELECT * FROM job_queue
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at, id
+                LIMIT ?
+            ''', (time.time(), limit))]
+            cursor.executemany("UPDATE job_queue SET status = 'running' WHERE id = ?",
+                               [(job['id'],) for job in jobs])
+        return jobs
+    
+    def complete_job(self, job_id, posts):
+        """Save a job's (prompt, content, platform, tone) results to history and drop the job, atomically"""
+        created_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        with self.db.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO content_history (prompt, content, platform, tone, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(*post, created_at) for post in posts])
+            cursor.execute('DELETE FROM job_queue WHERE id = ?', (job_id,))
+    
+    def retry_job(self, job_id, delay, error=None, count_attempt=True):
+        """Put a running job back in the queue, due again in delay seconds"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE job_queue
+                SET status = 'pending', next_attempt_at = ?, attempts = attempts + ?,
+                    last_error = coalesce(?, last_error)
+                WHERE id = ?
+            ''', (time.time() + delay, int(count_attempt), error, job_id))
+    
+    def fail_job(self, job_id, error):
+        """Give up on a job; it stays in the queue as failed until retried or cleared"""
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                UPDATE job_queue SET status = 'failed', attempts = attempts + 1, last_error = ?
+                WHERE id = ?
+            ''', (error, job_id))
+    
+    def requeue_jobs(self, statuses=('running',)):
+        """Make jobs in the given states pending and due now (e.g. ones cut off by a crash)"""
+        placeholders = ', '.join('?' * len(statuses))
+        with self.db.transaction() as cursor:
+            cursor.execute(f'''
+                UPDATE job_queue SET status = 'pending', next_attempt_at = ?
+                WHERE status IN ({placeholders})
+            ''', (time.time(), *statuses))
+            return cursor.rowcount
+    
+    def next_job_due(self):
+        """Time the next pending job is due, or None when nothing is pending"""
+        return self.db.query(
+            "SELECT min(next_attempt_at) FROM job_queue WHERE status = 'pending'"
+        )[0][0]
+    
+    def get_job_counts(self):
+        """Number of queued jobs per status"""
+        return dict(self.db.query('SELECT status, count(*) FROM job_queue GROUP BY status'))
+    
+    def get_cached_response(self, cache_keys):
+        """Return (provider, content) of the first live cache entry, in key order"""
+        if not cache_keys:
+            return None
         
-        cursor.execute('''
-            INSERT INTO content_history (prompt, content, platform, tone)
-            VALUES (?, ?, ?, ?)
-        ''', (prompt, content, platform, tone))
+        now = time.time()
+        placeholders = ', '.join('?' * len(cache_keys))
         
-        conn.commit()
-        conn.close()
+        with self.db.transaction() as cursor:
+            cursor.execute(f'''
+                SELECT cache_key, provider, content FROM response_cache
+                WHERE cache_key IN ({placeholders}) AND expires_at > ?
+            ''', (*cache_keys, now))
+            found = {key: (provider, content) for key, provider, content in cursor.fetchall()}
+            
+            hit = next((key for key in cache_keys if key in found), None)
+            if hit is not None:
+                cursor.execute('''
+                    UPDATE response_cache SET last_access = ?, hits = hits + 1
+                    WHERE cache_key = ?
+                ''', (now, hit))
+        
+        return found[hit] if hit is not None else None
     
-    def get_history(self, limit=50):
-        """Retrieve content history"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
+    def save_cached_response(self, cache_key, provider, model, content, ttl, max_entries):
+        """Store a provider response, evicting expired and least recently used entries"""
+        now = time.time()
         
-        cursor.execute('''
-            SELECT * FROM content_history
-            ORDER BY created_at DESC
-            LIMIT ?
-        ''', (limit,))
+        with self.db.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO response_cache
+                    (cache_key, provider, model, content, created_at, expires_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (cache_key, provider, model, content, now, now + ttl, now))
+            
+            cursor.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,))
+            cursor.execute('''
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache
+                    ORDER BY last_access DESC
+                    LIMIT -1 OFFSET ?
+                )
+            ''', (max_entries,))
+    
+    def clear_response_cache(self):
+        """Drop every cached provider response"""
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM response_cache')
+    
+    def get_provider_stats(self):
+        """Persisted provider health rows, latencies/outcomes decoded"""
+        rows = self.db.query('SELECT * FROM provider_stats', row_factory=sqlite3.Row)
+        stats = []
+        for row in rows:
+            row = dict(row)
+            row['latencies'] = json.loads(row['latencies'])
+            row['outcomes'] = json.loads(row['outcomes'])
+            stats.append(row)
+        return stats
+    
+    def save_provider_stats(self, provider, latencies, outcomes, consecutive_failures,
+                            state, opened_at, cooldown):
+        """Queue a provider health snapshot for the background writer"""
+        self.db.writer.put('''
+            INSERT OR REPLACE INTO provider_stats
+                (provider, latencies, outcomes, consecutive_failures, state,
+                 opened_at, cooldown, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (provider, json.dumps(latencies), json.dumps(outcomes), consecutive_failures,
+              state, opened_at, cooldown, time.time()))
+    
+    def save_request_metric(self, provider, model, kind, outcome, latency, ttfb=None,
+                            prompt_chars=None, response_chars=None, prompt_tokens=None,
+                            completion_tokens=None, fallback=False):
+        """Queue one provider call's telemetry for the background writer"""
+        bucket = bisect_left(LATENCY_BUCKETS_MS, latency * 1000)
+        self.db.writer.put('''
+            INSERT INTO request_metrics
+                (created_at, provider, model, kind, outcome, latency, latency_bucket, ttfb,
+                 prompt_chars, response_chars, prompt_tokens, completion_tokens, fallback)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (time.time(), provider, model, kind, outcome, latency, bucket, ttfb,
+              prompt_chars, response_chars, prompt_tokens, completion_tokens, int(fallback)))
         
-        rows = cursor.fetchall()
-        conn.close()
+        self.db.metrics_queued += 1
+        if self.db.metrics_queued % 1000 == 0:
+            # Old raw rows are only needed for ad-hoc digging, the aggregates stay
+            self.db.writer.put('''
+                DELETE FROM request_metrics
+                WHERE id <= (SELECT max(id) FROM request_metrics) - ?
+            ''', (METRICS_KEEP_ROWS,))
+    
+    def get_provider_metrics(self):
+        """
+        Per-provider request counts, error rate, token usage and latency percentiles
+        Read from the aggregate tables, so the cost does not grow with history.
+        """
+        self.flush()
+        rows = self.db.query('SELECT * FROM provider_metrics ORDER BY provider', row_factory=sqlite3.Row)
+        histograms = {}
+        for provider, bucket, count in self.db.query('SELECT provider, bucket, count FROM latency_histogram'):
+            counts = histograms.setdefault(provider, [0] * (len(LATENCY_BUCKETS_MS) + 1))
+            counts[min(bucket, len(LATENCY_BUCKETS_MS))] += count
         
-        return [dict(row) for row in rows]
+        metrics = []
+        for row in rows:
+            row = dict(row)
+            counts = histograms.get(row['provider'], [])
+            finished = row['ok'] + row['errors']
+            row['error_rate'] = row['errors'] / finished if finished else 0.0
+            row['fallback_rate'] = row['fallbacks'] / row['requests'] if row['requests'] else 0.0
+            row['mean_ms'] = row['latency_sum'] / row['ok'] * 1000 if row['ok'] else None
+            row['mean_ttfb_ms'] = row['ttfb_sum'] / row['ttfb_count'] * 1000 if row['ttfb_count'] else None
+            row['p50_ms'] = histogram_percentile(counts, 50)
+            row['p95_ms'] = histogram_percentile(counts, 95)
+            metrics.append(row)
+        return metrics
     
-    def clear_history(self):
-        """Clear all content history"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM content_history')
-        conn.commit()
-        conn.close()
+    def clear_metrics(self):
+        """Forget all request telemetry and aggregates"""
+        self.flush()
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM request_metrics')
+            cursor.execute('DELETE FROM provider_metrics')
+            cursor.execute('DELETE FROM latency_histogram')
@@ -0,0 +1,96 @@
+"""
+Background task runner shared by the whole app
+Runs blocking work on a fixed thread pool with cooperative cancellation
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CancelToken:
+    """Cooperative cancellation flag; a child token is also cancelled with its parent"""
+    
+    def __init__(self, parent=None):
+        self._event = threading.Event()
+        self._parent = parent
+    
+    def cancel(self):
+        self._event.set()
+    
+    def is_set(self):
+        return self._event.is_set() or (self._parent is not None and self._parent.is_set())
+    
+    def child(self):
+        return CancelToken(self)
+
+
+class TaskRunner:
+    """
+    Fixed pool of worker threads with callbacks delivered through dispatch
+    dispatch(fn) must run fn on the thread that owns the UI (the Kivy clock in
+    the app). Tasks submitted under a key supersede each other: submitting a
+    new one cancels the one still in flight.
+    """
+    
+    def __init__(self, max_workers=4, dispatch=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+        self._dispatch = dispatch or (lambda fn: fn())
+        self._keyed = {}
+        self._running = set()
+        # Re-entrant: cancelling a queued future runs its done callback right away
+        self._lock = threading.RLock()
+    
+    def submit(self, fn, *args, key=None, on_result=None, on_error=None, on_cancel=None, **kwargs):
+        """
+        Run fn(*args, cancel=token, **kwargs) on the pool and return its Future
+        Exactly one of on_result(result), on_error(exception) or on_cancel() is
+        dispatched when the task ends.
+        """
+        token = CancelToken()
+        with self._lock:
+            if key is not None and key in self._keyed:
+                self._cancel(*self._keyed[key])
+            future = self._executor.submit(fn, *args, cancel=token, **kwargs)
+            if key is not None:
+                self._keyed[key] = (token, future)
+            self._running.add((token, future))
+        future.add_done_callback(lambda f: self._finished(f, token, key, on_result, on_error, on_cancel))
+        return future
+    
+    def cancel(self, key):
+        """Cancel the task in flight under key, if any"""
+        with self._lock:
+            if key in self._keyed:
+                self._cancel(*self._keyed[key])
+    
+    def shutdown(self):
+        """Cancel everything and stop accepting work"""
+        with self._lock:
+            for token, future in list(self._running):
+                self._cancel(token, future)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+    
+    @staticmethod
+    def _cancel(token, future):
+        token.cancel()
+        # Not started yet: never start. Running: fn sees the token.
+        future.cancel()
+    
+    def _finished(self, future, token, key, on_result, on_error, on_cancel):
+        with self._lock:
+            self._running.discard((token, future))
+            if key is not None and self._keyed.get(key, (None,))[0] is token:
+                del self._keyed[key]
+        
+        if future.cancelled() or token.is_set():
+            if on_cancel is not None:
+                self._dispatch(on_cancel)
+            return
+        
+        error = future.exception()
+        if error is not None:
+            if on_error is not None:
+                self._dispatch(lambda: on_error(error))
+        elif on_result is not None:
+            result = future.result()
+            self._dispatch(lambda: on_result(result))
@@ -0,0 +1,168 @@
+"""
+Opening a database written by the original app migrates it in place
+The first release kept history in a plain content_history table and one key
+per provider in api_keys; StorageManager moves both into the current layout
+(and drops the old table), so nothing the user had may be lost on the way.
+
+    python -m pytest tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+# The app modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import StorageManager, SCHEMA_VERSION, COMPRESS_MIN_BYTES  # noqa: E402
+
+
+BASELINE_KEYS = {'groq': 'gsk-original-key', 'gemini': 'AIza-original-key'}
+
+# (id, prompt, content, platform, tone, created_at); gaps in the ids from deleted rows
+BASELINE_POSTS = [
+    (1, 'Launch day', 'We shipped it! 🚀 #launch', 'Twitter', 'Enthusiastic', '2024-01-01 09:00:00'),
+    (2, 'Launch day', 'Today we are launching our app to everyone.', 'LinkedIn', 'Professional',
+     '2024-01-01 09:05:00'),
+    (4, 'Café opening', 'Crème brûlée and espresso, come say hi ☕', 'Instagram', 'Casual', '2024-02-10 15:30:00'),
+    # Long enough to be stored compressed
+    (7, 'Quarterly report', 'Revenue grew steadily across every region this quarter. ' * 20, 'LinkedIn',
+     'Formal', '2024-03-31 18:00:00'),
+    (8, 'Monday motivation', 'Small steps every day add up to giant leaps.', 'Facebook', 'Inspirational',
+     '2024-04-01 07:00:00'),
+]
+
+
+def make_baseline_db(path):
+    """A database exactly as the first release of the app created and filled it"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            provider TEXT PRIMARY KEY,
+            api_key TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS content_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt TEXT NOT NULL,
+            content TEXT NOT NULL,
+            platform TEXT,
+            tone TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.executemany('INSERT INTO api_keys (provider, api_key) VALUES (?, ?)', BASELINE_KEYS.items())
+    conn.executemany('''
+        INSERT INTO content_history (id, prompt, content, platform, tone, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', BASELINE_POSTS)
+    conn.commit()
+    conn.close()
+
+
+class BaselineMigrationTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='aicg-test-')
+        self.db_path = os.path.join(self.workdir, 'ai_content_generator.db')
+        make_baseline_db(self.db_path)
+        self.storage = StorageManager(self.db_path)
+    
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def test_schema_is_current(self):
+        self.assertEqual(self.storage.db.query('PRAGMA user_version')[0][0], SCHEMA_VERSION)
+        kind = self.storage.db.query("SELECT type FROM sqlite_master WHERE name = 'content_history'")
+        self.assertEqual(kind, [('view',)])
+    
+    def test_history_rows_preserved(self):
+        rows = self.storage.db.query('''
+            SELECT id, prompt, content, platform, tone, created_at, image_path
+            FROM content_history ORDER BY id
+        ''')
+        self.assertEqual(rows, [(*post, None) for post in BASELINE_POSTS])
+    
+    def test_long_content_compressed_and_readable(self):
+        body = self.storage.db.query('SELECT body FROM post_bodies WHERE post_id = 7')[0][0]
+        self.assertIsInstance(body, bytes)
+        self.assertGreaterEqual(len(BASELINE_POSTS[3][2]), COMPRESS_MIN_BYTES)
+        self.assertEqual(self.storage.get_post(7)['content'], BASELINE_POSTS[3][2])
+    
+    def test_prompts_interned(self):
+        self.assertEqual(self.storage.db.query('SELECT count(*) FROM prompts')[0][0], 4)
+    
+    def test_api_keys_preserved(self):
+        self.assertEqual(self.storage.get_api_keys(), BASELINE_KEYS)
+        self.assertEqual(self.storage.get_api_key_pools(),
+                         {provider: [key] for provider, key in BASELINE_KEYS.items()})
+    
+    def test_search(self):
+        self.assertTrue(self.storage.db.has_fts)
+        self.assertEqual([row['id'] for row in self.storage.search_history('revenue')], [7])
+        # Prefix match on the last word, accents folded
+        self.assertEqual([row['id'] for row in self.storage.search_history('creme brul')], [4])
+        self.assertEqual({row['id'] for row in self.storage.search_history('launch')}, {1, 2})
+    
+    def test_history_pages(self):
+        newest_first = [post[0] for post in sorted(BASELINE_POSTS, key=lambda post: post[5], reverse=True)]
+        page, cursor = self.storage.get_history_page(limit=2)
+        ids = [row['id'] for row in page]
+        while cursor is not None:
+            page, cursor = self.storage.get_history_page(before=cursor, limit=2)
+            ids += [row['id'] for row in page]
+        self.assertEqual(ids, newest_first)
+        
+        page, _ = self.storage.get_history_page(limit=1)
+        self.assertEqual(page[0]['preview'], BASELINE_POSTS[4][2])
+        self.assertFalse(page[0]['truncated'])
+    
+    def test_new_posts_after_migration(self):
+        self.storage.save_post('Launch day', 'Still celebrating 🎉', 'Twitter', 'Casual')
+        self.storage.flush()
+        page, _ = self.storage.get_history_page(limit=1)
+        # Ids keep counting up from the migrated rows
+        self.assertGreater(page[0]['id'], max(post[0] for post in BASELINE_POSTS))
+        self.assertEqual([row['id'] for row in self.storage.search_history('celebrating')], [page[0]['id']])
+    
+    def test_reopen_is_stable(self):
+        self.storage.close()
+        self.storage = StorageManager(self.db_path)
+        self.assertEqual(len(self.storage.get_history(50)), len(BASELINE_POSTS))
+        self.assertEqual(self.storage.get_api_keys(), BASELINE_KEYS)
+
+
+
+class DeferredUpgradeTest(unittest.TestCase):
+    """The app opens the database on the UI thread and migrates it from a worker"""
+    
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='aicg-test-')
+        self.db_path = os.path.join(self.workdir, 'ai_content_generator.db')
+        make_baseline_db(self.db_path)
+        self.storage = StorageManager(self.db_path, upgrade=False)
+    
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def test_open_leaves_history_alone(self):
+        self.assertTrue(self.storage.needs_upgrade)
+        kind = self.storage.db.query("SELECT type FROM sqlite_master WHERE name = 'content_history'")
+        self.assertEqual(kind, [('table',)])
+    
+    def test_upgrade(self):
+        self.storage.upgrade()
+        self.assertFalse(self.storage.needs_upgrade)
+        self.assertEqual(self.storage.db.query('PRAGMA user_version')[0][0], SCHEMA_VERSION)
+        self.assertEqual(len(self.storage.get_history(50)), len(BASELINE_POSTS))
+        self.assertEqual([row['id'] for row in self.storage.search_history('revenue')], [7])
+
+
+if __name__ == '__main__':
+    unittest.main()
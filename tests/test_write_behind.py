@@ -0,0 +1,54 @@
+"""
+History is written behind the UI by a background writer
+The result screen asks whether its own posts made it to disk; the answer must
+not depend on who else flushed the queue or on unrelated rows that failed.
+
+    python -m pytest tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# The app modules live one directory up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import StorageManager  # noqa: E402
+
+
+class WriteBehindTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='aicg-test-')
+        self.storage = StorageManager(os.path.join(self.workdir, 'ai_content_generator.db'))
+    
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+    
+    def test_failed_post_reported_after_another_flush(self):
+        # prompts.text is NOT NULL, so this row can never be written
+        ticket = self.storage.save_post(None, 'Lost post', 'Twitter', 'Casual')
+        # A reader flushes the queue first (as opening History does)
+        self.storage.get_history_page()
+        self.assertFalse(self.storage.wait_saved(ticket))
+        self.assertEqual(self.storage.get_history(10), [])
+    
+    def test_unrelated_failure_does_not_fail_post(self):
+        ticket = self.storage.save_post('Launch day', 'We shipped it! 🚀', 'Twitter', 'Casual')
+        # A telemetry row that cannot be written lands in the same batch
+        failed = self.storage.db.writer.put('INSERT INTO no_such_table VALUES (?)', (1,))
+        self.storage.get_key_usage()
+        self.assertTrue(self.storage.wait_saved(ticket))
+        self.assertFalse(self.storage.wait_saved(failed))
+        self.assertEqual([row['content'] for row in self.storage.get_history(10)], ['We shipped it! 🚀'])
+    
+    def test_wait_does_not_need_a_flush(self):
+        ticket = self.storage.save_post('Launch day', 'Still celebrating 🎉', 'Twitter', 'Casual')
+        self.assertTrue(self.storage.wait_saved(ticket, timeout=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""
+Lightweight tracing
+Code marks its stages with span() blocks. When tracing is off a span is a
+shared no-op object; when on, spans are kept in memory as Chrome trace
+events and export() writes them out for chrome://tracing or ui.perfetto.dev.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+
+
+_enabled = False
+_events = deque(maxlen=200000)
+_thread_names = {}
+_lock = threading.Lock()
+_origin = time.perf_counter()
+
+
+class _NullSpan:
+    """Returned by span() while tracing is off"""
+    __slots__ = ()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'args', 'start')
+    
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        _add({
+            'name': self.name,
+            'ph': 'X',
+            'ts': (self.start - _origin) * 1e6,
+            'dur': (end - self.start) * 1e6,
+            'args': self.args,
+        })
+        return False
+    
+    def set(self, **args):
+        """Attach more arguments once they are known"""
+        self.args.update(args)
+
+
+def span(name, **args):
+    """Context manager timing a block; nearly free while tracing is off"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def instant(name, **args):
+    """A point in time, such as the first streamed chunk arriving"""
+    if _enabled:
+        _add({'name': name, 'ph': 'i', 's': 't', 'ts': (time.perf_counter() - _origin) * 1e6, 'args': args})
+
+
+def counter(name, **values):
+    """A sampled value, drawn as a graph track (e.g. frame time)"""
+    if _enabled:
+        _add({'name': name, 'ph': 'C', 'ts': (time.perf_counter() - _origin) * 1e6, 'args': values})
+
+
+def _add(event):
+    thread = threading.current_thread()
+    event['pid'] = os.getpid()
+    event['tid'] = thread.ident
+    with _lock:
+        _thread_names[thread.ident] = thread.name
+        _events.append(event)
+
+
+def enable(max_events=200000):
+    """Start recording; the oldest events are dropped past max_events"""
+    global _enabled, _events
+    with _lock:
+        if _events.maxlen != max_events:
+            _events = deque(_events, maxlen=max_events)
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def clear():
+    with _lock:
+        _events.clear()
+
+
+def event_count():
+    return len(_events)
+
+
+def export(path):
+    """Write the recorded events as Chrome trace-event JSON and return the path"""
+    with _lock:
+        events = list(_events)
+        names = dict(_thread_names)
+    pid = os.getpid()
+    metadata = [
+        {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+        for tid, name in names.items()
+    ]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+    return path
+
+
+# Lets a desktop run trace from the very first import
+if os.environ.get('AICG_TRACE'):
+    enable()